@@ -1,18 +1,204 @@
-from typing import List, Set, Dict, Tuple
+from typing import List, Set, FrozenSet, Dict, Tuple, Optional, Iterator
 from utils.iwt import IndexWildcardTree
+from utils.iwt_file import MappedIndexWildcardTree, load_iwt as load_iwt_file
+from utils.postings import intersect_all
+from utils.search_pool import SearchWorkerPool
+from utils.cache import LRUCache
+from utils.metrics import Metrics, NullMetrics, RequestStats, timer
 from cryptography.hazmat.primitives.asymmetric import ec
-from cryptography.hazmat.primitives import hashes
-from utils.serialize import deserialize_ctkmac, deserialize_cert
-from utils.misc import base_path, eval_policy
+from cryptography.hazmat.primitives import hashes, serialization
+from utils.serialize import deserialize_ctkmac, read_ctkmac, deserialize_cert, deserialize_iwt_delta
+from utils.misc import base_path, eval_policies
 from utils.crypto import ecc_decrypt
-import pprint, msgpack
+import pprint, msgpack, hashlib, threading, pathlib, tempfile, os, itertools, secrets, contextlib, time
+
+# Encrypted files are handed out in pieces of at most this many bytes, whatever their size
+TRANSFER_CHUNK_SIZE = 1 << 20
+
+def _iter_chunks(path: pathlib.Path, chunk_size: int) -> Iterator[Tuple[bytes, bool]]:
+    # (piece, last) pairs of a file; one piece is read ahead to know which one is the last
+    with open(path, 'rb') as file:
+        chunk = file.read(chunk_size)
+        while True:
+            following = file.read(chunk_size)
+            yield chunk, not following
+            if not following:
+                return
+            chunk = following
+
+def _file_identity(fileref: str) -> Optional[Tuple[int, int]]:
+    # (st_mtime_ns, st_size) of a stored encrypted file, None if it does not exist
+    try:
+        stat = os.stat(base_path / fileref)
+    except FileNotFoundError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
+
+def _check_fileref(fileref: str):
+    # Only plain names under base_path: no directories, absolute paths, '.' or '..'
+    if not isinstance(fileref, str) or pathlib.PurePath(fileref).name != fileref or fileref in ('', '.', '..'):
+        raise ValueError(f"Invalid file reference {fileref!r}")
+
+class _VerifiedCert:
+    """Cached outcome of verifying an attribute certificate, with the policy decisions made for it."""
+    __slots__ = ('pseudo_attributes', 'decisions')
+
+    def __init__(self, pseudo_attributes: List[str]):
+        self.pseudo_attributes = frozenset(pseudo_attributes)
+        self.decisions: Dict[str, bool] = {}    # Pseudo-policy -> access granted
+
+class _Cursor:
+    """Suspended search of one certificate and query set over one IWT, resumed by proceed_queries_page."""
+    __slots__ = ('cert_digest', 'queries_digest', 'iwt_tag', 'results', 'next_result')
+
+    def __init__(self, cert_digest: bytes, queries_digest: bytes, iwt_tag: tuple, results: Iterator[str]):
+        self.cert_digest = cert_digest
+        self.queries_digest = queries_digest
+        self.iwt_tag = iwt_tag
+        self.results = results
+        self.next_result: Optional[str] = None   # Read ahead to know a next page exists
 
 class CloudServer():
-    def __init__(self, ta_pubkey):
-        self.iwt: IndexWildcardTree = None
+    def __init__(self, ta_pubkey, cert_cache_size: int = 1024, cert_cache_ttl: Optional[float] = 300.0,
+                 policy_index_path = None, cursor_cache_size: int = 1024, cursor_ttl: Optional[float] = 300.0,
+                 result_cache_size: int = 4096, metrics: bool = False):
+        self.iwt: IndexWildcardTree | MappedIndexWildcardTree = None
         self.__private_key = ec.generate_private_key(ec.SECP256R1())
         self.public_key = self.__private_key.public_key()
+        # Verified certificates by digest of the encrypted attribute certificate
+        self.__cert_cache = LRUCache(cert_cache_size, cert_cache_ttl)
+        self.__revoked_certs: Set[bytes] = set()
         self.ta_publickey = ta_pubkey
+        self.__search_pool: Optional[SearchWorkerPool] = None
+        # Pseudo-policy of every registered encrypted file with the (st_mtime_ns, st_size) of the file it was
+        # read from, so a rewritten file is read again; optionally persisted to an append-only sidecar
+        self.__policy_index: Dict[str, Tuple[str, Optional[Tuple[int, int]]]] = {}
+        self.__policy_index_path = policy_index_path
+        self.__policy_index_lock = threading.Lock()
+        if policy_index_path is not None:
+            self.__load_policy_index()
+        # Search cursors handed out by proceed_queries_page
+        self.__cursors = LRUCache(cursor_cache_size, cursor_ttl)
+        # Authorized results by (IWT version tag, query set, pseudo-attributes); results of older
+        # versions are never looked up again and age out of the LRU
+        self.__result_cache = LRUCache(result_cache_size)
+        # Serializes IWT replacements and updates with their publication to the search workers
+        self.__update_lock = threading.Lock()
+        # Per-request counters and timers; NullMetrics collects nothing
+        self.metrics: Metrics | NullMetrics = Metrics() if metrics else NullMetrics()
+
+    @property
+    def ta_publickey(self):
+        return self.__ta_publickey
+
+    @ta_publickey.setter
+    def ta_publickey(self, ta_pubkey):
+        # Certificates verified under a previous TA key must be verified again
+        self.__ta_publickey = ta_pubkey
+        self.__cert_cache.clear()
+
+    def revoke_certificate(self, enc_attribute_cert: dict[str, bytes]):
+        """Reject an attribute certificate from now on, e.g. when the TA revokes its user."""
+        digest = self.__cert_digest(enc_attribute_cert)
+        self.__revoked_certs.add(digest)
+        self.__cert_cache.pop(digest)
+
+    def clear_certificate_cache(self):
+        self.__cert_cache.clear()
+
+    def certificate_cache_stats(self) -> Dict[str, int | float]:
+        return self.__cert_cache.stats()
+
+    def clear_result_cache(self):
+        self.__result_cache.clear()
+
+    def result_cache_stats(self) -> Dict[str, int | float]:
+        return self.__result_cache.stats()
+
+    def load_iwt(self, path):
+        """Serve searches from an IWT file saved with write_iwt, memory-mapped read-only."""
+        with self.__update_lock:
+            self.iwt = MappedIndexWildcardTree(path)
+            if self.__search_pool:
+                self.__search_pool.publish(self.iwt)
+
+    def upload_iwt(self, iwt_bytes: bytes):
+        """Replace the IWT with one sent by the Data Owner as the bytes of a file saved with write_iwt."""
+        fd, path = tempfile.mkstemp(suffix='.iwt')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(iwt_bytes)
+            iwt = load_iwt_file(path)
+        finally:
+            os.remove(path)
+        with self.__update_lock:
+            self.iwt = iwt
+            if self.__search_pool:
+                self.__search_pool.publish(self.iwt)
+
+    def start_search_workers(self, workers: Optional[int] = None, snapshot_dir: Optional[str] = None):
+        """Answer the trie part of proceed_queries in a pool of worker processes sharing a mapped IWT snapshot."""
+        if self.iwt is None:
+            raise Exception("No IWT to search, load or upload one before starting search workers")
+        if self.__search_pool:
+            self.stop_search_workers()
+        self.__search_pool = SearchWorkerPool(workers, snapshot_dir)
+        self.__search_pool.publish(self.iwt)
+
+    def stop_search_workers(self):
+        if self.__search_pool:
+            self.__search_pool.close()
+            self.__search_pool = None
+
+    def apply_iwt_delta(self, delta_bytes: bytes):
+        """
+        Apply an IWT delta from the Data Owner. Stale or out-of-order deltas are rejected.
+        Searches are not blocked: they keep reading the previous version until the delta is published.
+        """
+        if not isinstance(self.iwt, IndexWildcardTree):
+            raise Exception("IWT is a read-only mapped file, load a mutable copy with utils.iwt_file.load_iwt to apply updates")
+        delta = deserialize_iwt_delta(delta_bytes)
+        with self.__update_lock:
+            self.iwt.apply_delta(delta)
+            if self.__search_pool:
+                # In-flight worker queries finish on the previous snapshot
+                self.__search_pool.publish(self.iwt)
+
+    def upload_ehr(self, fileref: str, ctkmac_bytes: bytes):
+        """Store an encrypted file uploaded by the Data Owner and index its pseudo-policy."""
+        _check_fileref(fileref)
+        _, __, pseudo_policy = deserialize_ctkmac(ctkmac_bytes)
+        with open(base_path / fileref, 'wb') as enc_file:
+            enc_file.write(ctkmac_bytes)
+        self.__index_policy(fileref, pseudo_policy, _file_identity(fileref))
+
+    def register_files(self, filerefs: List[str]):
+        """Index the pseudo-policies of encrypted files already stored under base_path."""
+        for fileref in filerefs:
+            identity = _file_identity(fileref)
+            self.__index_policy(fileref, self.__read_policy(fileref), identity)
+
+    def fetch_ehrs(self, filerefs: List[str], enc_attribute_cert: dict[str, bytes]) -> Dict[str, bytes]:
+        """Encrypted files among filerefs whose pseudo-policy the certificate satisfies."""
+        pieces: Dict[str, List[bytes]] = {}
+        for fileref, chunk, _ in self.fetch_ehr_chunks(filerefs, enc_attribute_cert):
+            pieces.setdefault(fileref, []).append(chunk)
+        return {fileref: b''.join(chunks) for fileref, chunks in pieces.items()}
+
+    def fetch_ehr_chunks(self, filerefs: List[str], enc_attribute_cert: dict[str, bytes],
+                         chunk_size: int = TRANSFER_CHUNK_SIZE) -> Iterator[Tuple[str, bytes, bool]]:
+        """
+        Same files as fetch_ehrs, one after the other as (file reference, piece, last) triples of at most
+        chunk_size bytes, so a file of any size is read and sent in constant memory.
+        """
+        with self.__measure('fetch_ehrs') as stats:
+            cert = self.__authenticate(enc_attribute_cert, stats)
+            for fileref in filerefs:
+                _check_fileref(fileref)
+
+            for fileref in sorted(self.__check_policy(set(filerefs), cert, stats)):
+                for chunk, last in _iter_chunks(base_path / fileref, chunk_size):
+                    yield fileref, chunk, last
 
     def search(self, query: List[str]) -> Set[str]:
         files = self.iwt.search(query)
@@ -29,28 +215,244 @@ class CloudServer():
 
         return files
     
-    def proceed_queries(self, queries: List[List[str]], enc_attribute_cert: dict[str, bytes]) -> Set[str]:
+    def proceed_queries(self, queries: List[List[str]], enc_attribute_cert: dict[str, bytes]) -> FrozenSet[str]:
+        """
+        Authorized files matching all the queries. Results are cached per query set and pseudo-attribute set
+        until the IWT changes, so a repeated query only costs the certificate and cache lookups.
+        """
+        with self.__measure('proceed_queries') as stats:
+            cert = self.__authenticate(enc_attribute_cert, stats)
+            iwt = self.iwt.snapshot()   # One version for the whole request, even if an update lands meanwhile
+            key = self.__result_key(iwt, queries, cert)
+            final_ref = self.__result_cache.get(key)
+            if final_ref is not None:
+                if stats is not None:
+                    stats.count('result_cache_hits')
+                return final_ref
+
+            with timer(stats, 'trie_search'):
+                # Trie counters of a pool search stay in the worker processes
+                files = self.__pool_search(iwt, queries)
+                if files is None:
+                    # Intersect the postings bitmaps, file references are only materialized once
+                    postings = intersect_all([iwt.wildcard_postings(query, stats) for query in queries])
+                    files = iwt.file_ids.to_refs(postings)
+
+            # Check access policy
+            final_ref = frozenset(self.__check_policy(files, cert, stats))
+            # final_ref = files
+
+            self.__result_cache.put(key, final_ref)
+            return final_ref
+    
+    def stream_queries(self, queries: List[List[str]], enc_attribute_cert: dict[str, bytes],
+                       with_ciphertext: bool = False,
+                       chunk_size: int = TRANSFER_CHUNK_SIZE) -> Iterator[str | Tuple[str, bytes, bool]]:
+        """
+        Same results as proceed_queries, yielded one by one as soon as each file passes the policy check.
+        With with_ciphertext, each file is yielded instead as (file reference, piece, last) triples of
+        at most chunk_size bytes of its encrypted bytes, as fetch_ehr_chunks does.
+        """
+        with self.__measure('stream_queries') as stats:
+            cert = self.__authenticate(enc_attribute_cert, stats)
+
+            for fileref in self.__iter_results(self.iwt.snapshot(), queries, cert, stats):
+                if with_ciphertext:
+                    for chunk, last in _iter_chunks(base_path / fileref, chunk_size):
+                        yield fileref, chunk, last
+                else:
+                    yield fileref
+
+    def proceed_queries_page(self, queries: List[List[str]], enc_attribute_cert: dict[str, bytes], limit: int,
+                             cursor: Optional[str] = None) -> Tuple[Set[str], Optional[str]]:
+        """
+        At most limit authorized files matching the queries, and a cursor for the next page (None on the last one).
+        The trie traversal and policy checks stop as soon as the page is full and resume from where they
+        stopped when the cursor is passed back with the same queries and certificate. A cursor is single-use,
+        expires like cached certificates, and is rejected once the IWT has changed or with other queries.
+        Pages are always searched in process, lazily: search workers only return whole result sets.
+        """
+        if limit < 1:
+            raise ValueError("limit must be positive")
+
+        with self.__measure('proceed_queries_page') as stats:
+            cert = self.__authenticate(enc_attribute_cert, stats)
+            digest = self.__cert_digest(enc_attribute_cert)
+            queries_digest = hashlib.sha256(msgpack.packb(queries)).digest()
+            iwt = self.iwt.snapshot()
+            if cursor is None:
+                # The search outlives this request, so its trie and policy counters are not collected
+                state = _Cursor(digest, queries_digest, self.__iwt_tag(iwt), self.__iter_results(iwt, queries, cert))
+                page = []
+            else:
+                state = self.__cursors.get(cursor)
+                if state is None:
+                    raise Exception("Unknown or expired cursor")
+                if state.cert_digest != digest:
+                    raise Exception("Cursor was issued to another certificate")
+                if state.queries_digest != queries_digest:
+                    raise Exception("Cursor was issued for other queries")
+                # Checked before it is taken, so a mismatched request does not use up the cursor
+                if self.__cursors.pop(cursor) is None:
+                    raise Exception("Unknown or expired cursor")
+                if state.iwt_tag != self.__iwt_tag(iwt):
+                    raise Exception("IWT changed since the cursor was issued, search again")
+                page = [state.next_result]
+
+            # Read one result past the page to know whether there is a next one
+            with timer(stats, 'trie_search'):
+                page.extend(itertools.islice(state.results, limit + 1 - len(page)))
+            if len(page) <= limit:
+                cursor = None
+            else:
+                state.next_result = page.pop()
+                cursor = secrets.token_urlsafe(16)
+                self.__cursors.put(cursor, state)
+
+            if stats is not None:
+                stats.count('authorized_files', len(page))
+            return set(page), cursor
+
+    def proceed_query_batch(self, requests: List[Tuple[List[List[str]], dict[str, bytes]]]) -> List[Optional[FrozenSet[str]]]:
+        """
+        Serve the queries of many data users at once.
+        Identical and shared-prefix trapdoor patterns across all requests are traversed once,
+        and requests already in the result cache are not traversed at all.
+        Returns one result per request, None for a request whose certificate is invalid.
+        """
+        with self.__measure('proceed_query_batch') as stats:
+            authenticated: List[Optional[_VerifiedCert]] = []
+            for queries, enc_attribute_cert in requests:
+                try:
+                    authenticated.append(self.__authenticate(enc_attribute_cert, stats))
+                except Exception:
+                    authenticated.append(None)
+
+            iwt = self.iwt.snapshot()
+            keys = [self.__result_key(iwt, queries, cert) if cert else None
+                    for (queries, _), cert in zip(requests, authenticated)]
+            cached = [self.__result_cache.get(key) if key else None for key in keys]
+
+            patterns = [query for (queries, _), cert, hit in zip(requests, authenticated, cached)
+                        if cert and hit is None for query in queries]
+            with timer(stats, 'trie_search'):
+                matched = iwt.wildcard_postings_many(patterns, stats)
+
+            results = []
+            for (queries, _), cert, key, hit in zip(requests, authenticated, keys, cached):
+                if not cert:
+                    results.append(None)
+                    continue
+                if hit is not None:
+                    if stats is not None:
+                        stats.count('result_cache_hits')
+                    results.append(hit)
+                    continue
+
+                postings = intersect_all([matched[tuple(query)] for query in queries])
+                files = iwt.file_ids.to_refs(postings)
+                final_ref = frozenset(self.__check_policy(files, cert, stats))
+                self.__result_cache.put(key, final_ref)
+                results.append(final_ref)
+
+            return results
+    
+    @contextlib.contextmanager
+    def __measure(self, operation: str) -> Iterator[Optional[RequestStats]]:
+        # Stats of one request, None when metrics are disabled; recorded once the request ends, failed or not
+        stats = self.metrics.request(operation)
+        if stats is None:
+            yield None
+            return
+
+        start = time.perf_counter()
+        try:
+            yield stats
+        except Exception:
+            stats.count('errors')
+            raise
+        finally:
+            stats.add_time('request', time.perf_counter() - start)
+            self.metrics.record(stats)
+
+    def __iwt_tag(self, iwt) -> tuple:
+        # Identifies a version of a tree: its file id dictionary (compared by identity) is shared by all its versions
+        return (iwt.file_ids, iwt.version)
+
+    def __result_key(self, iwt, queries: List[List[str]], cert: _VerifiedCert) -> tuple:
+        # Results only hold for the IWT version they were computed on, which is part of the key.
+        # Queries are intersected, so their order and repetitions do not matter
+        return (self.__iwt_tag(iwt), frozenset(map(tuple, queries)), cert.pseudo_attributes)
+
+    def __iter_results(self, iwt, queries: List[List[str]], cert: _VerifiedCert,
+                       stats: Optional[RequestStats] = None) -> Iterator[str]:
+        for fileref in self.__iter_candidates(iwt, queries, stats):
+            allowed = self.__allowed(fileref, cert, stats)
+            if stats is not None:
+                stats.count('candidate_files')
+                stats.count('authorized_files', allowed)
+            if allowed:
+                yield fileref
+
+    def __pool_search(self, iwt, queries: List[List[str]]) -> Optional[Set[str]]:
+        # Matches from the search workers if they serve this snapshot, None to search in process instead.
+        # A tree changed without load_iwt, upload_iwt or apply_iwt_delta is published to them first
+        if not self.__search_pool:
+            return None
+        files = self.__search_pool.search(queries, iwt)
+        if files is None:
+            with self.__update_lock:
+                if self.__search_pool and self.__iwt_tag(self.iwt) == self.__iwt_tag(iwt):
+                    self.__search_pool.publish(iwt)
+            files = self.__search_pool.search(queries, iwt) if self.__search_pool else None
+        return files
+
+    def __iter_candidates(self, iwt, queries: List[List[str]], stats: Optional[RequestStats] = None) -> Iterator[str]:
+        # Walked in process even with search workers, which only answer whole result sets
+        if not queries:
+            return
+
+        # The first query is matched lazily, as far as the caller reads; the others filter it
+        others = (intersect_all([iwt.wildcard_postings(query, stats) for query in queries[1:]])
+                  if len(queries) > 1 else None)
+        for file_id in iwt.iter_wildcard_file_ids(queries[0], stats):
+            if others is None or file_id in others:
+                yield iwt.file_ids.decode(file_id)
+
+    def __authenticate(self, enc_attribute_cert: dict[str, bytes],
+                       stats: Optional[RequestStats] = None) -> _VerifiedCert:
+        digest = self.__cert_digest(enc_attribute_cert)
+        if digest in self.__revoked_certs:
+            raise Exception("Revoked certificate")
+
+        cert = self.__cert_cache.get(digest)
+        if cert is None:
+            cert = _VerifiedCert(self.__verify_enc_cert(enc_attribute_cert, stats))
+            self.__cert_cache.put(digest, cert)
+        elif stats is not None:
+            stats.count('cert_cache_hits')
+
+        return cert
+
+    def __cert_digest(self, enc_attribute_cert: dict[str, bytes]) -> bytes:
+        eph_pub_bytes = enc_attribute_cert["eph_pub"].public_bytes(serialization.Encoding.X962,
+                                                                   serialization.PublicFormat.UncompressedPoint)
+        return hashlib.sha256(eph_pub_bytes + enc_attribute_cert["iv"] + enc_attribute_cert["ciphertext"]).digest()
+
+    def __verify_enc_cert(self, enc_attribute_cert: dict[str, bytes],
+                          stats: Optional[RequestStats] = None) -> List[str]:
         # Decrypt attribute certificate
-        attribute_cert_bytes = ecc_decrypt(self.__private_key, enc_attribute_cert)
-        attribute_cert = deserialize_cert(attribute_cert_bytes)
+        with timer(stats, 'cert_decrypt'):
+            attribute_cert_bytes = ecc_decrypt(self.__private_key, enc_attribute_cert)
+            attribute_cert = deserialize_cert(attribute_cert_bytes)
         
         # Verify signature of attribute cert
-        pseudo_attributes = self.__verify_cert(attribute_cert, self.ta_publickey)
+        with timer(stats, 'cert_verify'):
+            pseudo_attributes = self.__verify_cert(attribute_cert, self.ta_publickey)
         if not pseudo_attributes:
             raise Exception("Invalid certificate signature")
         
-        files = set()
-        for query in queries:
-            if files:
-                files.intersection_update(self.wildcard_search(query))
-            else:
-                files.update(self.wildcard_search(query))
-
-        # Check access policy
-        final_ref = self.__check_policy(files, pseudo_attributes)
-        # final_ref = files
-
-        return final_ref
+        return pseudo_attributes
     
     def __verify_cert(self, attribute_cert: dict[str, List[str] | bytes], ta_pubkey) -> List[str] | False:
         pseudo_attributes = attribute_cert["pseudo_attributes"]
@@ -62,17 +464,80 @@ class CloudServer():
         except:
             return False
     
-    def __check_policy(self, file_references: Set[str], pseudo_attributes: List[str]):
-        final_ref = set()
+    def __check_policy(self, file_references: Set[str], cert: _VerifiedCert,
+                       stats: Optional[RequestStats] = None) -> Set[str]:
+        # Group the candidates by policy, so each distinct policy is decided once per certificate
+        files_by_policy: Dict[str, List[str]] = {}
         for fileref in file_references:
-            # deserialize encrypted file
-            enc_file_path = base_path / fileref
-            with open(enc_file_path, 'rb') as enc_file:
-                ctkmac_bytes = enc_file.read()
+            files_by_policy.setdefault(self.__policy_of(fileref, stats), []).append(fileref)
 
-            _, __, pseudo_policy = deserialize_ctkmac(ctkmac_bytes)
+        decisions = cert.decisions
+        undecided = [policy for policy in files_by_policy if policy not in decisions]
+        if undecided:
+            with timer(stats, 'policy_eval'):
+                decisions.update(zip(undecided, eval_policies(undecided, cert.pseudo_attributes)))
 
-            if eval_policy(pseudo_policy, pseudo_attributes):
-                final_ref.add(fileref)
+        final_ref = set()
+        for policy, filerefs in files_by_policy.items():
+            if decisions[policy]:
+                final_ref.update(filerefs)
+
+        if stats is not None:
+            stats.count('candidate_files', len(file_references))
+            stats.count('authorized_files', len(final_ref))
+            stats.count('policies_evaluated', len(undecided))
+        return final_ref
+
+    def __allowed(self, fileref: str, cert: _VerifiedCert, stats: Optional[RequestStats] = None) -> bool:
+        pseudo_policy = self.__policy_of(fileref, stats)
+        decision = cert.decisions.get(pseudo_policy)
+        if decision is None:
+            with timer(stats, 'policy_eval'):
+                decision = cert.decisions[pseudo_policy] = eval_policies([pseudo_policy], cert.pseudo_attributes)[0]
+            if stats is not None:
+                stats.count('policies_evaluated')
+        return decision
+
+    def __policy_of(self, fileref: str, stats: Optional[RequestStats] = None) -> str:
+        entry = self.__policy_index.get(fileref)
+        identity = _file_identity(fileref)
+        if entry is not None and (entry[1] == identity or identity is None):
+            # Unchanged since it was indexed, or gone: a missing file is not read again
+            return entry[0]
 
-        return final_ref
\ No newline at end of file
+        # Not registered yet, or rewritten since (e.g. re-encrypted under another policy): read it from the file
+        with timer(stats, 'policy_io'):
+            pseudo_policy = self.__read_policy(fileref)
+        if stats is not None:
+            stats.count('policy_file_reads')
+        self.__index_policy(fileref, pseudo_policy, identity)
+        return pseudo_policy
+
+    def __read_policy(self, fileref: str) -> str:
+        # deserialize encrypted file, up to the chunked ciphertext of a streamed one
+        with open(base_path / fileref, 'rb') as enc_file:
+            _, __, pseudo_policy, ___ = read_ctkmac(enc_file)
+        return pseudo_policy
+
+    def __index_policy(self, fileref: str, pseudo_policy: str, identity: Optional[Tuple[int, int]]):
+        with self.__policy_index_lock:
+            previous = self.__policy_index.get(fileref)
+            if previous == (pseudo_policy, identity):
+                return
+            self.__policy_index[fileref] = (pseudo_policy, identity)
+            if previous is not None and previous[0] != pseudo_policy:
+                # Cached results may include or omit this file under its old policy
+                self.__result_cache.clear()
+            if self.__policy_index_path is not None:
+                with open(self.__policy_index_path, 'ab') as sidecar:
+                    sidecar.write(msgpack.packb([fileref, pseudo_policy, *(identity or ())]))
+
+    def __load_policy_index(self):
+        # Later records win, so re-registered files keep their latest policy.
+        # Records without a file identity (older sidecars) are checked against the file on first use
+        try:
+            with open(self.__policy_index_path, 'rb') as sidecar:
+                for fileref, pseudo_policy, *identity in msgpack.Unpacker(sidecar):
+                    self.__policy_index[fileref] = (pseudo_policy, tuple(identity) if identity else None)
+        except FileNotFoundError:
+            pass
\ No newline at end of file
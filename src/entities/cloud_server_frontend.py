@@ -0,0 +1,235 @@
+"""
+Serves a CloudServer over TCP, with the framing of utils.net.
+"""
+import asyncio, contextlib, hmac
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Awaitable, Callable, Dict, Iterator, List, Optional, Protocol, Set, Tuple
+from utils.net import pack_frame, read_frame
+from utils.metrics import Metrics, NullMetrics
+from utils.serialize import deserialize_enc_cert
+
+class CloudService(Protocol):
+    """What CloudServerFrontend serves: the search and storage operations of a CloudServer."""
+    iwt: Any
+    metrics: Metrics | NullMetrics
+
+    def proceed_queries(self, queries: List[List[str]], enc_attribute_cert: dict) -> Set[str]: ...
+    def proceed_queries_page(self, queries: List[List[str]], enc_attribute_cert: dict, limit: int,
+                             cursor: Optional[str] = None) -> Tuple[Set[str], Optional[str]]: ...
+    def stream_queries(self, queries: List[List[str]], enc_attribute_cert: dict,
+                       with_ciphertext: bool = False) -> Iterator[Any]: ...
+    def fetch_ehr_chunks(self, filerefs: List[str], enc_attribute_cert: dict) -> Iterator[Tuple[str, bytes, bool]]: ...
+    def upload_ehr(self, fileref: str, ctkmac_bytes: bytes): ...
+    def upload_iwt(self, iwt_bytes: bytes): ...
+    def apply_iwt_delta(self, delta_bytes: bytes): ...
+
+def _close_quietly(items: Iterator):
+    # Closing runs the generator's cleanup, whose errors must not hide the one that ended the stream
+    with contextlib.suppress(Exception):
+        items.close()
+
+class CloudServerFrontend:
+    """
+    Serves a CloudServer over TCP.
+    Requests run in a thread pool, at most max_concurrency at a time over all connections.
+    A connection stops being read while max_pending of its requests are unanswered, so a
+    client that sends faster than it is served is slowed down by TCP flow control.
+    """
+
+    # op -> handler. IWT updates need no exclusion: searches read a snapshot of the tree
+    OPS = {
+        "proceed_queries": "_proceed_queries",
+        "proceed_queries_page": "_proceed_queries_page",
+        "metrics": "_metrics"
+    }
+    # Data Owner op -> handler, only served to requests carrying the owner token
+    OWNER_OPS = {
+        "upload_ehr": "_upload_ehr",
+        "upload_iwt": "_upload_iwt",
+        "apply_iwt_delta": "_apply_iwt_delta"
+    }
+    # op -> handler returning an iterator, each item is sent as soon as it is produced
+    STREAMS = {
+        "stream_queries": "_stream_queries",
+        "fetch_ehrs": "_fetch_ehrs"
+    }
+
+    def __init__(self, cloud_server: CloudService, host: str = '127.0.0.1', port: int = 0,
+                 max_concurrency: int = 16, max_pending: int = 64, owner_token: Optional[bytes] = None):
+        self.cloud_server = cloud_server
+        self.__owner_token = owner_token     # Shared with the Data Owner out of band, None disables the owner ops
+        self.host = host
+        self.port = port
+        self.max_concurrency = max_concurrency
+        self.max_pending = max_pending
+        self.__executor = ThreadPoolExecutor(max_workers=max_concurrency)
+        self.__limit: Optional[asyncio.Semaphore] = None
+        self.__server: Optional[asyncio.AbstractServer] = None
+        self.__connections: Dict[asyncio.Task, asyncio.StreamWriter] = {}
+
+    async def start(self):
+        """Start listening; with port 0 the chosen port is stored in self.port."""
+        self.__limit = asyncio.Semaphore(self.max_concurrency)
+        self.__server = await asyncio.start_server(self.__handle, self.host, self.port)
+        self.port = self.__server.sockets[0].getsockname()[1]
+
+    async def serve_forever(self):
+        if self.__server is None:
+            await self.start()
+        await self.__server.serve_forever()
+
+    async def close(self):
+        """Stop accepting connections and close the open ones once their in-flight requests are answered."""
+        if self.__server is not None:
+            self.__server.close()
+            for writer in self.__connections.values():
+                writer.transport.close()
+            await asyncio.gather(*self.__connections, return_exceptions=True)
+            await self.__server.wait_closed()
+            self.__server = None
+        self.__executor.shutdown(wait=True)
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def __handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        connection = asyncio.current_task()
+        self.__connections[connection] = writer
+        window = asyncio.Semaphore(self.max_pending)
+        write_lock = asyncio.Lock()
+        pending: Dict[Any, asyncio.Task] = {}     # Unanswered requests by request id
+        try:
+            while True:
+                await window.acquire()
+                try:
+                    frame = await read_frame(reader)
+                except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+                    # Closed by the client, or garbage on the stream
+                    break
+                if not isinstance(frame, list) or len(frame) != 3 or not isinstance(frame[0], int):
+                    break
+
+                request_id, op, args = frame
+                if op == "cancel":
+                    # The client stopped reading a request: stop producing its frames, no response
+                    window.release()
+                    task = pending.get(args[0]) if isinstance(args, list) and args else None
+                    if task is not None:
+                        task.cancel()
+                    continue
+
+                task = asyncio.create_task(self.__respond(frame, writer, write_lock, window))
+                pending[request_id] = task
+                task.add_done_callback(lambda task, request_id=request_id:
+                                       pending.pop(request_id) if pending.get(request_id) is task else None)
+        finally:
+            if pending:
+                await asyncio.gather(*pending.values(), return_exceptions=True)
+            writer.close()
+            with contextlib.suppress(ConnectionError):
+                await writer.wait_closed()
+            del self.__connections[connection]
+
+    async def __respond(self, frame: list, writer: asyncio.StreamWriter, write_lock: asyncio.Lock,
+                        window: asyncio.Semaphore):
+        request_id, op, args = frame
+
+        async def send(ok: Optional[bool], result: Any):
+            # Packed before taking the stream, so a frame that cannot be sent leaves nothing half-written
+            frame = pack_frame([request_id, ok, result])
+            async with write_lock:
+                writer.write(frame)
+                await writer.drain()
+
+        try:
+            try:
+                if op in self.STREAMS:
+                    await self.__stream(op, args, send)
+                    result = None
+                else:
+                    result = await self.__run(op, args)
+                # A result too large for a frame, or not serializable, is answered with an error
+                await send(True, result)
+            except ConnectionError:
+                raise
+            except Exception as e:
+                await send(False, str(e) or type(e).__name__)
+        except ConnectionError:
+            pass
+        finally:
+            window.release()
+
+    async def __run(self, op: str, args: list) -> Any:
+        if op in self.OWNER_OPS:
+            if not args or not self.__is_owner(args[0]):
+                raise Exception(f"Operation {op!r} requires the data owner token")
+            handler, args = self.OWNER_OPS[op], args[1:]
+        elif op in self.OPS:
+            handler = self.OPS[op]
+        else:
+            raise ValueError(f"Unknown operation {op!r}")
+        async with self.__limit:
+            return await asyncio.get_running_loop().run_in_executor(self.__executor, getattr(self, handler), *args)
+
+    def __is_owner(self, token: Any) -> bool:
+        return (self.__owner_token is not None and isinstance(token, bytes)
+                and hmac.compare_digest(token, self.__owner_token))
+
+    async def __stream(self, op: str, args: list, send: Callable[[Optional[bool], Any], Awaitable[None]]):
+        loop = asyncio.get_running_loop()
+        done = object()
+        async with self.__limit:
+            items = await loop.run_in_executor(self.__executor, getattr(self, self.STREAMS[op]), *args)
+            step: Optional[Future] = None
+            try:
+                # Waiting for the send to drain keeps a slow reader from buffering the whole result
+                while True:
+                    step = self.__executor.submit(next, items, done)
+                    item = await asyncio.wrap_future(step)
+                    if item is done:
+                        break
+                    await send(None, item)
+            finally:
+                if step is not None and not step.done():
+                    # Cancelled while a thread runs the generator, which cannot be closed until it stops
+                    step.add_done_callback(lambda _: _close_quietly(items))
+                else:
+                    _close_quietly(items)
+
+    def _proceed_queries(self, queries: List[List[str]], enc_attribute_cert: dict[str, bytes]) -> List[str]:
+        return list(self.cloud_server.proceed_queries(queries, deserialize_enc_cert(enc_attribute_cert)))
+
+    def _proceed_queries_page(self, queries: List[List[str]], enc_attribute_cert: dict[str, bytes], limit: int,
+                              cursor: Optional[str] = None) -> Tuple[List[str], Optional[str]]:
+        files, cursor = self.cloud_server.proceed_queries_page(queries, deserialize_enc_cert(enc_attribute_cert),
+                                                              limit, cursor)
+        return list(files), cursor
+
+    def _stream_queries(self, queries: List[List[str]], enc_attribute_cert: dict[str, bytes],
+                        with_ciphertext: bool = False) -> Iterator[str | Tuple[str, bytes, bool]]:
+        return self.cloud_server.stream_queries(queries, deserialize_enc_cert(enc_attribute_cert), with_ciphertext)
+
+    def _fetch_ehrs(self, filerefs: List[str], enc_attribute_cert: dict[str, bytes]) -> Iterator[Tuple[str, bytes, bool]]:
+        return self.cloud_server.fetch_ehr_chunks(filerefs, deserialize_enc_cert(enc_attribute_cert))
+
+    def _upload_ehr(self, fileref: str, ctkmac_bytes: bytes):
+        self.cloud_server.upload_ehr(fileref, ctkmac_bytes)
+
+    def _upload_iwt(self, iwt_bytes: bytes) -> int:
+        self.cloud_server.upload_iwt(iwt_bytes)
+        return self.cloud_server.iwt.version
+
+    def _apply_iwt_delta(self, delta_bytes: bytes) -> int:
+        self.cloud_server.apply_iwt_delta(delta_bytes)
+        return self.cloud_server.iwt.version
+
+    def _metrics(self, format: str = 'prometheus') -> str:
+        if format == 'prometheus':
+            return self.cloud_server.metrics.to_prometheus()
+        if format == 'json':
+            return self.cloud_server.metrics.to_json()
+        raise ValueError(f"Unknown metrics format {format!r}")
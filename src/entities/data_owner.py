@@ -1,28 +1,120 @@
-from charm.schemes.abenc.abenc_bsw07 import CPabe_BSW07
 from charm.toolbox.pairinggroup import GT
 from charm.core.engine.util import objectToBytes, bytesToObject
 from utils.mac import HomomorphicMAC, gen_pseudo_policy
-from utils.crypto import aes_encrypt, aes_decrypt
+from utils.cpabe import CachedCPabe_BSW07
+from utils.trapdoor import TrapdoorEngine
+from utils.crypto import aes_encrypt, aes_decrypt, aes_encrypt_stream
 from utils.misc import base_path
 from utils.serialize import serialize_ctk, serialize_ctkmac
-from utils.iwt import IndexWildcardTree
-from charm.toolbox.pairinggroup import ZR
-from typing import List, Tuple, Any
-import hashlib, hmac
+from utils.iwt import IndexWildcardTree, IWTDelta
+from charm.toolbox.pairinggroup import ZR, PairingGroup
+from concurrent.futures import Future, ProcessPoolExecutor
+from collections import deque
+from typing import Deque, Iterable, Iterator, List, Optional, Set, Tuple, Any
+import hashlib
 from .data_user import DataUser
 import pprint, os, pathlib
 
 global_keywords = ['A+', 'Married', 'Type 2 Diabetes', 'Diabetes', 'Hypertension', 'Chronic Conditions', 'Coronary Artery Disease']
 
+# Files at least this large are encrypted as a chunked stream instead of in memory
+STREAM_THRESHOLD = 64 << 20
+
+def _enc_file_name(filename: str) -> str:
+    number = pathlib.PurePath(filename).name.split('.')[0].split('_')[-1]
+    return f"{number}_encrypted"
+
+def _is_generated(filename: str) -> bool:
+    # Outputs of encrypt_ehr and decrypt_ehr, never inputs to encrypt
+    return filename.endswith('_encrypted') or filename.endswith('_decrypted.txt')
+
+def _claim_output(outputs: Set[str], path: str) -> str:
+    # Encrypted file name of an input, unless an earlier input of the batch already writes it
+    enc_file_name = _enc_file_name(path)
+    if enc_file_name in outputs:
+        raise ValueError(f"{path} would overwrite {enc_file_name}, which another input is encrypted to")
+    outputs.add(enc_file_name)
+    return enc_file_name
+
+def _derive_keys(group, cpabe_key) -> Tuple[bytes, Any]:
+    cpabe_key_bytes = group.serialize(cpabe_key)
+    half_len = len(cpabe_key_bytes) // 2
+    encrypting_key = hashlib.sha256(cpabe_key_bytes[:half_len]).digest()      # K_enc
+    mac_key = group.deserialize(b'0:' + cpabe_key_bytes[half_len:])    # K_mac
+    return (encrypting_key, mac_key)
+
+def _gen_mac(mac_context: HomomorphicMAC, group, message, secret_key) -> Any:
+    # Per-file key on the long-lived generators and their precomputed tables
+    hashval = group.hash(message, ZR)
+    mac = mac_context.with_key(secret_key).sign(hashval)
+    return mac
+
+def _encrypt_file(group, cpabe, mac_context: HomomorphicMAC, mpk, pseudo_key: bytes,
+                  plain_file_path: pathlib.Path, enc_file_path: pathlib.Path,
+                  access_policy: str, stream: Optional[bool] = None):
+    """
+    Encrypt a file under an access policy into an encrypted file (ctk, mac, pseudo-policy).
+    A streamed file (stream, or by default files of at least STREAM_THRESHOLD bytes) keeps no ciphertext
+    in its ctk: the chunked AES-GCM ciphertext follows the ctkmac, written in constant memory.
+    """
+    if stream is None:
+        stream = os.path.getsize(plain_file_path) >= STREAM_THRESHOLD
+
+    # Derive symmetric encryption key
+    cpabe_key = group.random(GT)
+    (encrypting_key, mac_key) = _derive_keys(group, cpabe_key)
+
+    # Encrypt the message M under the key k
+    if stream:
+        ciphertext, iv = None, None
+    else:
+        with open(plain_file_path, 'rb') as plain_file:
+            message = plain_file.read()
+        ciphertext, iv = aes_encrypt(encrypting_key, message)
+
+    # Encrypt keys with CP-ABE
+    encrypted_key_bytes = objectToBytes(cpabe.encrypt(mpk, cpabe_key, access_policy), group)
+    ctk_bytes = serialize_ctk(encrypted_key_bytes, ciphertext, iv)
+
+    # Generate integrity tag over the ciphertext (a stream authenticates its frames itself)
+    mac_bytes = group.serialize(_gen_mac(mac_context, group, ctk_bytes, mac_key))
+
+    # Generate pseudo-policy
+    pseudo_policy = gen_pseudo_policy(pseudo_key, access_policy)
+
+    with open(enc_file_path, 'wb') as enc_file:
+        enc_file.write(serialize_ctkmac(ctk_bytes, mac_bytes, pseudo_policy))
+        if stream:
+            aes_encrypt_stream(encrypting_key, plain_file_path, enc_file)
+
+# Pairing group, CP-ABE scheme, MAC context, MPK, pseudo key and experiment flag of an encrypt_ehrs worker process
+_worker_state: Optional[Tuple[Any, Any, HomomorphicMAC, Any, bytes, bool]] = None
+
+def _init_encrypt_worker(group_type: str, mpk_bytes: bytes, pseudo_key: bytes, is_experiment: bool):
+    # Pairing groups and their elements cannot be pickled: rebuild them once per worker
+    global _worker_state
+    group = PairingGroup(group_type)
+    _worker_state = (group, CachedCPabe_BSW07(group), HomomorphicMAC.setup(group), bytesToObject(mpk_bytes, group),
+                     pseudo_key, is_experiment)
+
+def _encrypt_worker(path: str, access_policy: str) -> str:
+    group, cpabe, mac_context, mpk, pseudo_key, is_experiment = _worker_state
+    enc_file_name = _enc_file_name(path)
+    plain_file_path = base_path / ("test_ehr_1.txt" if is_experiment else path)
+    _encrypt_file(group, cpabe, mac_context, mpk, pseudo_key, plain_file_path, base_path / enc_file_name, access_policy)
+    return enc_file_name
+
 class DataOwner():
     def __init__(self, ta_mpk, group, is_experiment: bool = False):
         self.ta_mpk = ta_mpk    # MPK from TA
         self.__group = group
         self.public_params = {}
-        self.__cpabe = CPabe_BSW07(self.__group)
+        self.__cpabe = CachedCPabe_BSW07(self.__group)     # Policies and attribute hashes are reused across files
+        self.__mac = HomomorphicMAC.setup(self.__group)   # Shared generators, fixed-base tables built once
         self.__iwt = IndexWildcardTree()
         self.__trapdoor_key_cpabe = self.__group.random(GT)  # To be encrypted using CP-ABE
         self.__trapdoor_key = hashlib.sha256(self.__group.serialize(self.__trapdoor_key_cpabe)).digest() # K_td
+        self.__trapdoors = TrapdoorEngine(self.__trapdoor_key)
         self.__pseudo_key = None
         self.is_experiment = is_experiment
 
@@ -42,55 +134,62 @@ class DataOwner():
     def pseudo_key(self, key: bytes):
         self.__pseudo_key = key
 
-    # def encrypt_ehrs(self, pkap: List[Tuple]):
-    #     cts = []
-    #     for (number, keywords, access_policy) in pkap:
-    #         ct = self.__encrypt_ehr(number, keywords, access_policy)
-    #         cts.append(ct)
-    #     return cts
-    
-    def encrypt_ehr(self, filename: str, access_policy: str) -> Tuple[str, List]:
-        number = filename.split('.')[0].split('_')[-1]
-        plain_file_path = base_path / filename
-        
-        if self.is_experiment:
-            with open(base_path / "test_ehr_1.txt", 'rb') as plain_file:
-                message = plain_file.read()
-        else:
-            with open(plain_file_path, 'rb') as plain_file:
-                message = plain_file.read()
-            
-        # Randonly select a secret
-        s = self.__group.random(ZR)
-
-        # Derive symmetric encryption key
-        # k = self.public_params['H2'](hmac_key, str(s))
-        # k_bytes = k.to_bytes(32)
-        cpabe_key = self.__group.random(GT)
-        (encrypting_key, mac_key) = self.__derive_keys(cpabe_key)
-
-        # Encrypt the message M under the key k
-        ciphertext, iv = aes_encrypt(encrypting_key, message)
-        
-        # Encrypt keys with CP-ABE
-        encrypted_key_bytes = self.__encrypt_key(cpabe_key, access_policy)
-        ctk_bytes = serialize_ctk(encrypted_key_bytes, ciphertext, iv)
-        
-        # Generate integrity tag over the ciphertext using HMAC
-        mac = self.__gen_mac(ctk_bytes, mac_key)
-        mac_bytes = self.__group.serialize(mac)
-
-        # Generate pseudo-policy
+    def encrypt_ehrs(self, source: str | os.PathLike | Iterable[Tuple[str, str]], access_policy: Optional[str] = None,
+                     workers: Optional[int] = None, max_pending: Optional[int] = None) -> Iterator[str]:
+        """
+        Encrypt many files in a pool of worker processes, yielding the encrypted file references in input order.
+        source is a directory, whose files are all encrypted under access_policy, or an iterable of
+        (path, access policy) pairs; paths are relative to base_path. Every worker sets up its pairing group
+        and keys once and reads, encrypts and writes its files itself, so I/O overlaps with the pairing work
+        of the others. At most max_pending files (default 4 per worker) are queued at a time.
+        A directory's earlier *_encrypted and *_decrypted.txt outputs are skipped. Inputs that would be
+        encrypted to the same file raise ValueError, before any work for a directory or a list.
+        """
         if not self.pseudo_key:
             raise Exception("DO has no pseudo key")
-        pseudo_policy = gen_pseudo_policy(self.__pseudo_key, access_policy)
+        if isinstance(source, (str, os.PathLike)):
+            if access_policy is None:
+                raise ValueError("access_policy is required to encrypt a directory")
+            directory = base_path / source
+            source = [(str(path), access_policy) for path in sorted(directory.iterdir())
+                      if path.is_file() and not _is_generated(path.name)]
+        if isinstance(source, (list, tuple)):
+            outputs: Set[str] = set()
+            for path, _ in source:
+                _claim_output(outputs, str(path))
+
+        workers = workers or os.cpu_count() or 1
+        return self.__encrypt_pipeline(source, workers, max_pending or 4 * workers)
 
-        ctkmac_bytes = serialize_ctkmac(ctk_bytes, mac_bytes, pseudo_policy)
+    def __encrypt_pipeline(self, source: Iterable[Tuple[str, str]], workers: int, max_pending: int) -> Iterator[str]:
+        executor = ProcessPoolExecutor(workers, initializer=_init_encrypt_worker,
+                                       initargs=(self.__group.groupType(), objectToBytes(self.ta_mpk, self.__group),
+                                                 self.__pseudo_key, self.is_experiment))
+        pending: Deque[Future] = deque()
+        outputs: Set[str] = set()
+        try:
+            for path, policy in source:
+                # Workers writing the same file would silently overwrite each other
+                _claim_output(outputs, str(path))
+                pending.append(executor.submit(_encrypt_worker, str(path), policy))
+                if len(pending) >= max_pending:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            # Also reached when the caller stops reading early: drop what has not started
+            executor.shutdown(wait=True, cancel_futures=True)
 
-        enc_file_name = f"{number}_encrypted"
-        enc_file_path = base_path / enc_file_name
-        with open(enc_file_path, 'wb') as enc_file:
-            enc_file.write(ctkmac_bytes)
+    def encrypt_ehr(self, filename: str, access_policy: str, stream: Optional[bool] = None) -> Tuple[str, List]:
+        """Encrypt one file; stream forces (True) or prevents (False) chunked encryption, see _encrypt_file."""
+        plain_file_path = base_path / ("test_ehr_1.txt" if self.is_experiment else filename)
+
+        if not self.pseudo_key:
+            raise Exception("DO has no pseudo key")
+
+        enc_file_name = _enc_file_name(filename)
+        _encrypt_file(self.__group, self.__cpabe, self.__mac, self.ta_mpk, self.__pseudo_key,
+                      plain_file_path, base_path / enc_file_name, access_policy, stream)
 
         # Mark as discard
         idx = []
@@ -103,41 +202,32 @@ class DataOwner():
         CT = (enc_file_name, idx)  # To be uploaded to Cloud Server
         return CT
     
-    def __derive_keys(self, cpabe_key) -> Tuple[bytes, Any]:
-        cpabe_key_bytes = self.__group.serialize(cpabe_key)
-        half_len = len(cpabe_key_bytes) // 2
-        encrypting_key = hashlib.sha256(cpabe_key_bytes[:half_len]).digest()      # K_enc
-        mac_key = self.__group.deserialize(b'0:' + cpabe_key_bytes[half_len:])    # K_mac
-        return (encrypting_key, mac_key)
-    
-    def __encrypt_key(self, cpabe_key, access_policy) -> bytes:
-        encrypted_key = self.__cpabe.encrypt(self.ta_mpk, cpabe_key, access_policy)
-        encrypted_key_bytes = objectToBytes(encrypted_key, self.__group)
-        return encrypted_key_bytes
-
-    def __gen_mac(self, message, secret_key) -> Any:
-        mac_generator = HomomorphicMAC(self.__group, secret_key)
-        hashval = self.__group.hash(message, ZR)
-        mac = mac_generator.sign(hashval)
-        return mac
-    
     def send_enc_trapdoor_key(self, dus: List[DataUser]):
         enc_trapdoor_key = self.__cpabe.encrypt(self.ta_mpk, self.__trapdoor_key_cpabe, '(0)')
         for du in dus:
             du.recv_enc_trapdoor_key(enc_trapdoor_key)
 
     def construct_iwt(self, kwfile_map: List[Tuple[str, str]]):
-        for keyword, filename in kwfile_map:
-            trapdoor = self.__gen_trapdoor(keyword)
-            self.__iwt.insert(trapdoor, filename)
+        # One transaction: every node is copied at most once and the whole batch is published together
+        trapdoors = self.__trapdoors.generate_many(keyword for keyword, _ in kwfile_map)
+        with self.__iwt.transaction():
+            for trapdoor, (_, filename) in zip(trapdoors, kwfile_map):
+                self.__iwt.insert(trapdoor, filename)
 
         # pprint.pprint(self.__iwt.get_word_files_mapping())
 
-    def __gen_trapdoor(self, keyword: str) -> List[str]:
-        keyword = keyword.encode()
-        trapdoor = []
-        for i in range(1, len(keyword)+1):
-            td = hmac.new(self.__trapdoor_key, keyword[0:i], hashlib.sha256).hexdigest()
-            trapdoor.append(td)
-        return trapdoor
+    def update_iwt(self, new_kwfile_map: List[Tuple[str, str]] | None = None,
+                   removed_kwfile_map: List[Tuple[str, str]] | None = None,
+                   removed_files: List[str] | None = None) -> IWTDelta:
+        """Apply keyword insertions/removals to the IWT and return the delta to ship to the Cloud Server."""
+        new_kwfile_map, removed_kwfile_map = new_kwfile_map or [], removed_kwfile_map or []
+        new_trapdoors = self.__trapdoors.generate_many(keyword for keyword, _ in new_kwfile_map)
+        removed_trapdoors = self.__trapdoors.generate_many(keyword for keyword, _ in removed_kwfile_map)
+        delta = IWTDelta(self.__iwt.version, self.__iwt.version + 1,
+                         [(trapdoor, filename) for trapdoor, (_, filename) in zip(new_trapdoors, new_kwfile_map)],
+                         [(trapdoor, filename) for trapdoor, (_, filename) in zip(removed_trapdoors, removed_kwfile_map)],
+                         list(removed_files or []))
+        self.__iwt.apply_delta(delta)
+        return delta
+
     
\ No newline at end of file
@@ -1,10 +1,45 @@
-from typing import Dict, List
+from typing import Dict, List, Optional, Set, Iterable, Iterator, Tuple, AsyncIterator
 from utils.misc import base_path
-from utils.serialize import deserialize_ctk, deserialize_ctkmac
-from utils.crypto import aes_decrypt
+from utils.net import CloudServerClient
+from utils.trapdoor import TrapdoorEngine
+from utils.serialize import deserialize_ctk, read_ctkmac
+from utils.crypto import aes_decrypt, aes_decrypt_stream
 from charm.core.engine.util import bytesToObject
 from charm.schemes.abenc.abenc_bsw07 import CPabe_BSW07
-import hashlib, hmac
+import hashlib, asyncio, pathlib, io, os, tempfile
+
+class _Reassembler:
+    """
+    Rebuilds encrypted files received as (file reference, piece, last) triples, one file after the other.
+    A file received in one piece is kept in memory; a longer one is spooled to a temporary file, so
+    memory stays at about one piece whatever the file size.
+    """
+
+    def __init__(self):
+        self.__spool = None     # (open file, path) of the file being received
+
+    def add(self, chunk: bytes, last: bool) -> Optional[bytes | str]:
+        """The file's bytes or temporary path once its last piece is added, None before."""
+        if self.__spool is None:
+            if last:
+                return chunk
+            fd, path = tempfile.mkstemp(suffix='.enc')
+            self.__spool = (os.fdopen(fd, 'wb'), path)
+        spool, path = self.__spool
+        spool.write(chunk)
+        if not last:
+            return None
+        spool.close()
+        self.__spool = None
+        return path
+
+    def close(self):
+        # Drops a file cut off before its last piece
+        if self.__spool is not None:
+            spool, path = self.__spool
+            spool.close()
+            os.remove(path)
+            self.__spool = None
 
 class DataUser():
     def __init__(self, attributes: Dict[str, str], ta_mpk, group, id: int = 0, is_experiment: bool = False):
@@ -16,6 +51,7 @@ class DataUser():
         self.__public_params = {}
         self.__cpabe = CPabe_BSW07(self.__group)
         self.__trapdoor_key = None
+        self.__trapdoors: TrapdoorEngine | None = None
         self.attribute_cert = None
         self.is_experiment = is_experiment
         
@@ -50,13 +86,47 @@ class DataUser():
             filepaths.append(path)
         return filepaths
 
+    def decrypt_ehr_stream(self, enc_chunks: Iterable[Tuple[str, bytes, bool]]) -> Iterator[pathlib.Path]:
+        """
+        Decrypt files received as (file reference, piece, last) triples, e.g. from
+        CloudServer.stream_queries(..., with_ciphertext=True), yielding each decrypted file path.
+        """
+        files = _Reassembler()
+        try:
+            for filename, chunk, last in enc_chunks:
+                received = files.add(chunk, last)
+                if received is not None:
+                    yield self.__decrypt_received(filename, received)
+        finally:
+            files.close()
+
     def decrypt_ehr(self, filename: str):
-        number = filename.split('_')[0]
-        enc_file_path = base_path / filename
+        return self.__decrypt_file(filename, base_path / filename)
+
+    def decrypt_ehr_bytes(self, filename: str, ctkmac_bytes: bytes):
+        """Decrypt an encrypted file received as bytes, e.g. fetched from a remote cloud server."""
+        ctk_bytes, mac_bytes, _, body_offset = read_ctkmac(io.BytesIO(ctkmac_bytes))
+        return self.__decrypt(filename, ctk_bytes, mac_bytes, ctkmac_bytes, body_offset)
+
+    def __decrypt_file(self, filename: str, enc_file_path: str | os.PathLike):
         with open(enc_file_path, 'rb') as enc_file:
-            ctkmac_bytes = enc_file.read()
+            ctk_bytes, mac_bytes, _, body_offset = read_ctkmac(enc_file)
+
+        # A streamed file is decrypted from the file itself, memory-mapped
+        return self.__decrypt(filename, ctk_bytes, mac_bytes, enc_file_path, body_offset)
+
+    def __decrypt_received(self, filename: str, received: bytes | str):
+        # Reassembled in memory, or spooled to a temporary file removed once decrypted
+        if isinstance(received, bytes):
+            return self.decrypt_ehr_bytes(filename, received)
+        try:
+            return self.__decrypt_file(filename, received)
+        finally:
+            os.remove(received)
 
-        ctk_bytes, mac_bytes, policy = deserialize_ctkmac(ctkmac_bytes)
+    def __decrypt(self, filename: str, ctk_bytes: bytes, mac_bytes: bytes, enc_file: pathlib.Path | bytes,
+                  body_offset: int):
+        number = filename.split('_')[0]
 
         mac = self.__group.deserialize(mac_bytes)
         # check mac here
@@ -68,12 +138,24 @@ class DataUser():
             raise Exception(f"DU: {self.id} | file: {filename} | decrypt_key: decrypt unsuccessful")
         
         (encrypting_key, mac_key) = self.__derive_keys(cpabe_key)
+        decrypted_file_path = base_path / f"{number}_decrypted.txt"
+
+        if ciphertext is None:
+            # Chunked AES-GCM ciphertext after the ctkmac, decrypted frame by frame
+            output_path = os.devnull if self.is_experiment else decrypted_file_path
+            try:
+                with open(output_path, 'wb') as dec_file:
+                    aes_decrypt_stream(encrypting_key, enc_file, dec_file, body_offset)
+            except:
+                if not self.is_experiment:
+                    decrypted_file_path.unlink(missing_ok=True)
+                raise Exception(f"DU{self.id} decrypt_ehr: decrypt unsuccessful")
+            return decrypted_file_path
+
         try:
             message = aes_decrypt(encrypting_key, ciphertext, iv)
         except:
             raise Exception(f"DU{self.id} decrypt_ehr: decrypt unsuccessful")
-        
-        decrypted_file_path = base_path / f"{number}_decrypted.txt"
 
         if not self.is_experiment:
             with open(decrypted_file_path, 'wb') as dec_file:
@@ -97,27 +179,44 @@ class DataUser():
         try:
             trapdoor_key_cpabe = self.__cpabe.decrypt(self.ta_mpk, self.__secret_key, enc_trapdoor_key)
             self.__trapdoor_key = hashlib.sha256(self.__group.serialize(trapdoor_key_cpabe)).digest()
+            self.__trapdoors = TrapdoorEngine(self.__trapdoor_key)
         except:
             raise Exception(f"DU{self.id} recv_enc_trapdoor_key: decrypt unsuccessful")
 
     def query(self, queries: List[str]) -> List[List[str]]:
-        trapdoors = []
-        for i, q in enumerate(queries):
-            td = self.__gen_trapdoor(q.encode())
-            trapdoors.append(td)
-            # print(f"\tquery {i}: {q}")
-            # print(f"\t\ttrapdoor: {td[0]}")   # only print first character
-        return trapdoors
-
-    def __gen_trapdoor(self, keyword: bytes) -> List[str]:
-        trapdoor = []
-        for i in range(0, len(keyword)):
-            if keyword[i] in [42, 63]:  # *, ?
-                td = chr(keyword[i])
-            else:
-                td = hmac.new(self.__trapdoor_key, keyword[0:i+1], hashlib.sha256).hexdigest()
-
-            trapdoor.append(td)
-
-        return trapdoor
+        if self.__trapdoors is None:
+            raise Exception(f"DU{self.id} query: no trapdoor key")
+        # '*' and '?' stay as they are in the trapdoor, every other prefix is HMACed
+        return self.__trapdoors.generate_many(queries, wildcards=True)
+
+    async def search_remote(self, client: CloudServerClient, keywords: List[str]) -> Set[str]:
+        """Query a remote cloud server; returns the encrypted files this user may access."""
+        return await client.proceed_queries(self.query(keywords), self.attribute_cert)
+
+    async def retrieve_remote(self, client: CloudServerClient, keywords: List[str]):
+        """Search a remote cloud server, fetch the matching encrypted files and decrypt them."""
+        filenames = await self.search_remote(client, keywords)
+        return [path async for path in self.__decrypt_chunks(client.fetch_ehr_chunks(sorted(filenames),
+                                                                                      self.attribute_cert))]
+
+    async def retrieve_remote_stream(self, client: CloudServerClient, keywords: List[str]) -> AsyncIterator[pathlib.Path]:
+        """
+        Decrypt files while the remote search is still running, yielding each decrypted file path.
+        Decryption runs off the event loop so the next results keep arriving meanwhile.
+        """
+        async for path in self.__decrypt_chunks(client.stream_queries(self.query(keywords), self.attribute_cert,
+                                                                      with_ciphertext=True)):
+            yield path
+
+    async def __decrypt_chunks(self, enc_chunks: AsyncIterator[Tuple[str, bytes, bool]]) -> AsyncIterator[pathlib.Path]:
+        # Files arrive in bounded pieces and are reassembled before decryption, see _Reassembler
+        files = _Reassembler()
+        try:
+            async for filename, chunk, last in enc_chunks:
+                received = await asyncio.to_thread(files.add, chunk, last)
+                if received is not None:
+                    yield await asyncio.to_thread(self.__decrypt_received, filename, received)
+        finally:
+            files.close()
+
     
\ No newline at end of file
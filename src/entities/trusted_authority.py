@@ -122,6 +122,11 @@ class TrustedAuthority():
 
         return enc_attribute_cert
 
+    def rotate_signing_key(self):
+        """Replace the attribute certificate signing key. Reissue certificates and give CS the new public_key."""
+        self.__private_key = ec.generate_private_key(ec.SECP384R1())
+        self.public_key = self.__private_key.public_key()
+
     def test_serial(self):
         a = self.group.random(GT)
         asr = self.group.serialize(a)
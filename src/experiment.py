@@ -3,7 +3,13 @@ from entities.data_user import DataUser
 from entities.data_owner import DataOwner
 from entities.cloud_server import CloudServer
 from utils.misc import print_header, measure_computation_time
-import string, secrets, random, math
+from utils.iwt import IndexWildcardTree, RadixIndexWildcardTree, SummaryPolicy
+from utils.iwt_file import write_iwt, load_iwt, MappedIndexWildcardTree
+from entities.cloud_server_frontend import CloudServerFrontend
+from utils.net import CloudServerClient
+from utils.trapdoor import TrapdoorEngine
+from typing import List
+import string, secrets, random, math, os, time, tracemalloc, tempfile, asyncio, statistics, threading
 
 def wildcard_suffix(keyword: str, percentage: int) -> str:
     if not 0 <= percentage <= 100:
@@ -15,6 +21,220 @@ def wildcard_suffix(keyword: str, percentage: int) -> str:
 
     return keyword[:cut_off] + "*"
 
+def random_trapdoors(keyword_count: int, keyword_length: int) -> List[List[str]]:
+    # Same token layout as DataOwner's trapdoors: one HMAC per keyword prefix
+    keywords = [''.join(secrets.choice(string.ascii_lowercase)
+                        for _ in range(keyword_length))
+                        for _ in range(keyword_count)]
+    return TrapdoorEngine(os.urandom(32)).generate_many(keywords)
+
+def run_iwt_memory(round_num, keyword_length, keyword_in_tree_count, file_count):
+    print_header(f"ROUND {round_num}", 40)
+    print(f"Keyword length: {keyword_length}, keywords in IWT: {keyword_in_tree_count}, files: {file_count}")
+
+    trapdoors = random_trapdoors(keyword_in_tree_count, keyword_length)
+
+    for name, tree_cls in [("IWT", IndexWildcardTree), ("Radix IWT", RadixIndexWildcardTree)]:
+        tracemalloc.start()
+        start_time = time.time()
+        tree = tree_cls()
+        for trapdoor in trapdoors:
+            for i in range(1, file_count+1):
+                tree.insert(trapdoor, f"{i}_encrypted")
+        build_ms = (time.time() - start_time) * 1000
+        current, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"    {name}:\t{tree.node_count()} nodes\t{current / 2**20:.2f} MiB\t{build_ms:.2f} ms build")
+
+    print()
+
+def run_iwt_summary(round_num, keyword_length, keyword_in_tree_count):
+    print_header(f"ROUND {round_num}", 40)
+    print(f"Keyword length: {keyword_length}, keywords in IWT: {keyword_in_tree_count}")
+
+    trapdoors = random_trapdoors(keyword_in_tree_count, keyword_length)
+
+    policies = [("none", SummaryPolicy.disabled()),
+                ("root only", SummaryPolicy.root_only()),
+                ("every 8th depth", SummaryPolicy.every_nth_depth(8)),
+                ("every depth", SummaryPolicy.every_nth_depth(1))]
+
+    for name, policy in policies:
+        tracemalloc.start()
+        start_time = time.time()
+        tree = IndexWildcardTree(policy)
+        for trapdoor in trapdoors:
+            tree.insert(trapdoor, "1_encrypted")
+        tree.build_summaries()
+        build_ms = (time.time() - start_time) * 1000
+        current, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"    {name}:\t{current / 2**20:.2f} MiB\t{build_ms:.2f} ms build")
+
+    print()
+
+def run_wildcard_worst_case(round_num, keyword_length, keyword_in_tree_count):
+    print_header(f"ROUND {round_num}", 40)
+    print(f"Keyword length: {keyword_length}, keywords in IWT: {keyword_in_tree_count}")
+
+    trapdoors = random_trapdoors(keyword_in_tree_count, keyword_length)
+    target = trapdoors[0]
+
+    patterns = [("*?*?*", ['*', '?', '*', '?', '*']),
+                ("leading *", ['*', target[-1]]),
+                ("*x*", ['*', target[len(target) // 2], '*']),
+                ("*?*?* miss", ['*', '?', '*', '?', '*', 'miss'])]
+
+    for name, tree_cls in [("IWT", IndexWildcardTree), ("Radix IWT", RadixIndexWildcardTree)]:
+        tree = tree_cls()
+        for trapdoor in trapdoors:
+            tree.insert(trapdoor, "1_encrypted")
+
+        for pattern_name, pattern in patterns:
+            print(f"    {name} '{pattern_name}'", end="\t")
+            measure_computation_time(tree.wildcard_files_only, pattern, iterations=100)
+
+    print()
+
+def run_prefix_wildcard(round_num, keyword_in_tree_count):
+    print_header(f"ROUND {round_num}", 40)
+    print(f"Keywords in IWT: {keyword_in_tree_count}")
+
+    trapdoors = random_trapdoors(keyword_in_tree_count, 16)
+    tree = IndexWildcardTree()
+    for i, trapdoor in enumerate(trapdoors):
+        tree.insert(trapdoor, f"{i}_encrypted")
+
+    # One-token prefix: its subtree holds about 1/26 of the index
+    print("    Prefix 'x*'", end="\t")
+    measure_computation_time(tree.wildcard_files_only, [trapdoors[0][0], '*'], iterations=1000)
+    print()
+
+def run_iwt_file(round_num, keyword_in_tree_count):
+    print_header(f"ROUND {round_num}", 40)
+    print(f"Keywords in IWT: {keyword_in_tree_count}")
+
+    trapdoors = random_trapdoors(keyword_in_tree_count, 16)
+    tree = IndexWildcardTree()
+    for i, trapdoor in enumerate(trapdoors):
+        tree.insert(trapdoor, f"{i}_encrypted")
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "iwt.bin")
+        start_time = time.time()
+        write_iwt(tree, path)
+        print(f"    Save:\t{(time.time() - start_time) * 1000:.2f} ms, {os.path.getsize(path) / 2**20:.2f} MiB")
+
+        start_time = time.time()
+        load_iwt(path)
+        print(f"    Full load:\t{(time.time() - start_time) * 1000:.2f} ms")
+
+        start_time = time.time()
+        mapped = MappedIndexWildcardTree(path)
+        print(f"    Map:\t{(time.time() - start_time) * 1000:.2f} ms")
+
+        print("    In-memory query", end="\t")
+        measure_computation_time(tree.wildcard_files_only, trapdoors[0][:4] + ['*'], iterations=1000)
+        print("    Mapped query", end="\t")
+        measure_computation_time(mapped.wildcard_files_only, trapdoors[0][:4] + ['*'], iterations=1000)
+        mapped.close()
+
+    print()
+
+def run_concurrent_ingest(round_num, keyword_in_tree_count, reader_count=4, duration=2.0):
+    print_header(f"ROUND {round_num}", 40)
+    print(f"Keywords in IWT: {keyword_in_tree_count}, reader threads: {reader_count}")
+
+    trapdoors = random_trapdoors(keyword_in_tree_count, 16)
+    tree = IndexWildcardTree()
+    with tree.transaction():
+        for i, trapdoor in enumerate(trapdoors):
+            tree.insert(trapdoor, f"{i}_encrypted")
+    ingest = random_trapdoors(keyword_in_tree_count, 16)
+
+    def measure(writer=None):
+        stop = threading.Event()
+        counts = [0] * reader_count
+
+        def reader(n):
+            while not stop.is_set():
+                tree.wildcard_postings(random.choice(trapdoors)[:4] + ['*'])
+                counts[n] += 1
+
+        threads = [threading.Thread(target=reader, args=(n,)) for n in range(reader_count)]
+        if writer is not None:
+            threads.append(threading.Thread(target=writer, args=(stop,)))
+        for thread in threads:
+            thread.start()
+        time.sleep(duration)
+        stop.set()
+        for thread in threads:
+            thread.join()
+        return sum(counts) / duration
+
+    def writer(stop):
+        # Ingest bursts of 100 keywords, each published as one version
+        i = 0
+        while not stop.is_set() and i < len(ingest):
+            with tree.transaction():
+                for trapdoor in ingest[i:i + 100]:
+                    tree.insert(trapdoor, f"new_{i}_encrypted")
+            i += 100
+
+    print(f"    Queries/s, idle:\t\t{measure():.0f}")
+    print(f"    Queries/s, during ingest:\t{measure(writer):.0f}")
+    print()
+
+def run_network_load(round_num, client_count, requests_per_client, keyword_in_tree_count):
+    print_header(f"ROUND {round_num}", 40)
+    print(f"Clients: {client_count}, requests per client: {requests_per_client}, keywords in IWT: {keyword_in_tree_count}")
+
+    keywords = [''.join(secrets.choice(string.ascii_lowercase) for _ in range(16))
+                for _ in range(keyword_in_tree_count)]
+    attributes = {str(i): str(i) for i in range(10)}
+    ACCESS_POLICY = '(' + ' or '.join(attributes.values()) + ')'
+
+    TA = TrustedAuthority()
+    CS = CloudServer(TA.public_key)
+    TA.cloud_publickey = CS.public_key
+    DO = DataOwner(TA.master_public_key, TA.group, True)
+    DU_test = DataUser(attributes, TA.master_public_key, TA.group, is_experiment=True)
+    TA.send_publicparams([DU_test, DO])
+    TA.send_secretkey_and_cert([DU_test])
+    DO.pseudo_key = TA.pseudo_key
+
+    ct_ref = DO.encrypt_ehr('test_ehr_1.txt', ACCESS_POLICY)[0]
+    DO.construct_iwt([(keyword, ct_ref) for keyword in keywords])
+    DO.send_enc_trapdoor_key([DU_test])
+    queries = [DU_test.query([random.choice(keywords)]) for _ in range(100)]
+
+    async def client_load(port, latencies):
+        # Each client pipelines all of its requests on one connection
+        async with await CloudServerClient.connect(port=port) as client:
+            async def timed(query):
+                start_time = time.perf_counter()
+                await client.proceed_queries(query, DU_test.attribute_cert)
+                latencies.append(time.perf_counter() - start_time)
+            await asyncio.gather(*(timed(random.choice(queries)) for _ in range(requests_per_client)))
+
+    async def load():
+        owner_token = secrets.token_bytes(32)
+        async with CloudServerFrontend(CS, owner_token=owner_token) as frontend:
+            async with await CloudServerClient.connect(port=frontend.port, owner_token=owner_token) as client:
+                await client.upload_iwt(DO.iwt)
+
+            latencies = []
+            start_time = time.perf_counter()
+            await asyncio.gather(*(client_load(frontend.port, latencies) for _ in range(client_count)))
+            return latencies, time.perf_counter() - start_time
+
+    latencies, elapsed = asyncio.run(load())
+    percentiles = statistics.quantiles(latencies, n=100)
+    print(f"    p50:\t\t{percentiles[49] * 1000:.3f} ms")
+    print(f"    p99:\t\t{percentiles[98] * 1000:.3f} ms")
+    print(f"    Throughput:\t{len(latencies) / elapsed:.1f} requests/s")
+    print()
+
 def run_scheme(round_num, attribute_count, keyword_length, 
                keyword_in_tree_count, query_count, wildcard_percentage,
                file_count):
@@ -59,8 +279,7 @@ Ciphertext file count:\t{file_count}
 
     # ct_ref, idx = DO.encrypt_ehr('test_ehr_1.txt', ACCESS_POLICY)
 
-    ct_refs = [DO.encrypt_ehr(f'test_ehr_{i}.txt', ACCESS_POLICY)[0]
-               for i in range(1, file_count+1)]
+    ct_refs = list(DO.encrypt_ehrs((f'test_ehr_{i}.txt', ACCESS_POLICY) for i in range(1, file_count+1)))
     
     # Phase 4: Trapdoor Generation and Query ===============================
     kwfile_map =[(keyword, ct_ref) for keyword in keywords for ct_ref in ct_refs]
@@ -68,6 +287,7 @@ Ciphertext file count:\t{file_count}
     DO.construct_iwt(kwfile_map)    
     DO.send_enc_trapdoor_key([DU_test])  
     CS.iwt = DO.iwt    
+    CS.register_files(ct_refs)
 
     # randomly choose keyword to query
     wildcard_queries = [random.choice(keywords) if wildcard_percentage <= 0
@@ -109,7 +329,14 @@ if __name__ == "__main__":
         "keyword_in_tree_counts": 0,
         "query_counts": 0,
         "wildcard_percentages": 0,
-        "file_counts": 1
+        "file_counts": 1,
+        "iwt_memory": 0,
+        "iwt_summary": 0,
+        "wildcard_worst_case": 0,
+        "prefix_wildcard": 0,
+        "iwt_file": 0,
+        "network_load": 0,
+        "concurrent_ingest": 0
     }
 
     # Attribute counts dependent
@@ -158,4 +385,59 @@ if __name__ == "__main__":
                        keyword_in_tree_count=20, 
                        query_count=1, 
                        wildcard_percentage=0, 
-                       file_count=file_count)
\ No newline at end of file
+                       file_count=file_count)
+
+    # IWT memory footprint, standard vs path-compressed
+    if (to_run_test["iwt_memory"]):
+        print_header("IWT MEMORY", 40)
+        for i, keyword_len in enumerate(KEYWORD_LENGTHS):
+            run_iwt_memory(round_num=i,
+                           keyword_length=keyword_len,
+                           keyword_in_tree_count=20,
+                           file_count=1)
+
+    # IWT Bloom filter summary policies
+    if (to_run_test["iwt_summary"]):
+        print_header("IWT SUMMARY POLICY", 40)
+        for i, keyword_in_tree_count in enumerate(KEYWORD_IN_TREE_COUNTS):
+            run_iwt_summary(round_num=i,
+                            keyword_length=16,
+                            keyword_in_tree_count=keyword_in_tree_count)
+
+    # Worst-case wildcard patterns on deep tries
+    if (to_run_test["wildcard_worst_case"]):
+        print_header("WILDCARD WORST CASE", 40)
+        for i, keyword_len in enumerate(KEYWORD_LENGTHS + [2000]):
+            run_wildcard_worst_case(round_num=i,
+                                    keyword_length=keyword_len,
+                                    keyword_in_tree_count=20)
+
+    # Trailing-'*' queries over growing indexes
+    if (to_run_test["prefix_wildcard"]):
+        print_header("PREFIX WILDCARD", 40)
+        for i, keyword_in_tree_count in enumerate([1000, 10000, 50000]):
+            run_prefix_wildcard(round_num=i,
+                                keyword_in_tree_count=keyword_in_tree_count)
+
+    # Saved IWT: restart by memory-mapping vs full load
+    if (to_run_test["iwt_file"]):
+        print_header("IWT FILE", 40)
+        for i, keyword_in_tree_count in enumerate([1000, 10000, 50000]):
+            run_iwt_file(round_num=i,
+                         keyword_in_tree_count=keyword_in_tree_count)
+
+    # Localhost client-server deployment under concurrent pipelined load
+    if (to_run_test["network_load"]):
+        print_header("NETWORK LOAD", 40)
+        for i, client_count in enumerate([1, 4, 16, 64]):
+            run_network_load(round_num=i,
+                             client_count=client_count,
+                             requests_per_client=200,
+                             keyword_in_tree_count=1000)
+
+    # Search throughput while the IWT is being updated
+    if (to_run_test["concurrent_ingest"]):
+        print_header("CONCURRENT INGEST", 40)
+        for i, keyword_in_tree_count in enumerate([1000, 10000, 50000]):
+            run_concurrent_ingest(round_num=i,
+                                  keyword_in_tree_count=keyword_in_tree_count)
\ No newline at end of file
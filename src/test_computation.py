@@ -1,6 +1,6 @@
 from typing import Callable, Any, List, Tuple
 from charm.toolbox.pairinggroup import PairingGroup, G1, G2, GT, ZR
-from utils.misc import measure_computation_time
+from utils.misc import measure_computation_time, eval_policy
 from utils.mac import HomomorphicMAC
 import hmac, hashlib, os, random, time
 
@@ -38,6 +38,15 @@ if __name__ == "__main__":
 
     # print(f'Verification of aggregated tag is {"successful" if valid else "unsuccessful"}')
 
+    print("HomoMAC signing, new context per key vs long-lived context:")
+    sk = group.random(ZR)
+    m = group.hash("A"*1000, ZR)
+    measure_computation_time(lambda: HomomorphicMAC(group, sk).sign(m), iterations=1000)
+    mac_context = HomomorphicMAC.setup(group)
+    measure_computation_time(lambda: mac_context.with_key(sk).sign(m), iterations=1000)
+    print("HomoMAC sign_many (40 tags):")
+    measure_computation_time(mac_context.with_key(sk).sign_many, hashes[:40], iterations=100)
+
     # print('a: ', a)
     # print('b: ', b)
     # print('g0: ', g0)
@@ -60,3 +69,7 @@ if __name__ == "__main__":
 
     print("HMAC:")
     measure_computation_time(lambda: hmac.new(key, message, hashlib.sha256).digest(), iterations=10000)
+
+    print("Policy evaluation (compiled, cached):")
+    policy_attrs = frozenset(['DOCTOR', 'CARDIOLOGY', 'LICENSED'])
+    measure_computation_time(eval_policy, '((DOCTOR and CARDIOLOGY) or (RESEARCHER and (PHD or MEDIUM)))', policy_attrs, iterations=10000)
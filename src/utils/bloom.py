@@ -1,42 +1,121 @@
 import math
+import struct
 import mmh3
+from typing import Iterable, List
 
 class BloomFilter:
-    """Simple Bloom filter implementation using multiple hash functions."""
-    
+    """
+    Bit-packed Bloom filter.
+    Bits live in a bytearray (1 bit per slot) and the k indexes of an item are derived
+    by double hashing from a single 128-bit MurmurHash3 call.
+    """
+
+    # capacity, error rate, bit array size, hash count
+    _HEADER = struct.Struct('<QdQI')
+
     def __init__(self, capacity: int = 1000, error_rate: float = 0.01):
         self.capacity = capacity
         self.error_rate = error_rate
-        
+
         # Calculate optimal bit array size and number of hash functions
         self.bit_array_size = self._calculate_bit_array_size()
         self.hash_count = self._calculate_hash_count()
-        
+
         # Initialize bit array
-        self.bit_array = [False] * self.bit_array_size
-        
+        self.bit_array = bytearray((self.bit_array_size + 7) // 8)
+
     def _calculate_bit_array_size(self) -> int:
         """Calculate optimal bit array size based on capacity and error rate."""
-        return int(-(self.capacity * math.log(self.error_rate)) / (math.log(2) ** 2))
-    
+        return max(8, int(-(self.capacity * math.log(self.error_rate)) / (math.log(2) ** 2)))
+
     def _calculate_hash_count(self) -> int:
         """Calculate optimal number of hash functions."""
-        return int((self.bit_array_size / self.capacity) * math.log(2))
-    
-    def _hash(self, item: str, seed: int) -> int:
-        """Generate hash value for an item with given seed."""
-        return mmh3.hash(item, seed) % self.bit_array_size
-    
-    def add(self, item: str):
+        return max(1, int((self.bit_array_size / self.capacity) * math.log(2)))
+
+    def _indexes(self, item: str | bytes) -> List[int]:
+        """Bit indexes of an item: h1 + i*h2 (mod m) from one unsigned 128-bit hash (x64 variant)."""
+        digest = mmh3.hash128(item, 0, x64arch=True, signed=False)
+        h1 = digest & 0xFFFFFFFFFFFFFFFF
+        h2 = (digest >> 64) | 1     # Odd, so the probes never collapse to h1 alone
+        m = self.bit_array_size
+        return [(h1 + i * h2) % m for i in range(self.hash_count)]
+
+    def add(self, item: str | bytes):
         """Add an item to the Bloom filter."""
-        for i in range(self.hash_count):
-            index = self._hash(item, i)
-            self.bit_array[index] = True
-    
-    def contains(self, item: str) -> bool:
+        bit_array = self.bit_array
+        for index in self._indexes(item):
+            bit_array[index >> 3] |= 1 << (index & 7)
+
+    def contains(self, item: str | bytes) -> bool:
         """Check if an item might be in the set (no false negatives, possible false positives)."""
-        for i in range(self.hash_count):
-            index = self._hash(item, i)
-            if not self.bit_array[index]:
+        bit_array = self.bit_array
+        for index in self._indexes(item):
+            if not bit_array[index >> 3] & (1 << (index & 7)):
                 return False
-        return True
\ No newline at end of file
+        return True
+
+    def add_many(self, items: Iterable[str | bytes]):
+        """Add several items at once."""
+        for item in items:
+            self.add(item)
+
+    def contains_many(self, items: Iterable[str | bytes]) -> List[bool]:
+        """Membership check for several items, in order."""
+        return [self.contains(item) for item in items]
+
+    def union(self, other: 'BloomFilter') -> 'BloomFilter':
+        """Return a new filter holding the items of both filters. Both must share the same geometry."""
+        if (self.bit_array_size, self.hash_count) != (other.bit_array_size, other.hash_count):
+            raise ValueError("Cannot union Bloom filters with different size or hash count")
+
+        result = BloomFilter(self.capacity, self.error_rate)
+        merged = int.from_bytes(self.bit_array, 'little') | int.from_bytes(other.bit_array, 'little')
+        result.bit_array = bytearray(merged.to_bytes(len(self.bit_array), 'little'))
+        return result
+
+    def copy(self) -> 'BloomFilter':
+        """Independent copy of the filter."""
+        bloom = BloomFilter.__new__(BloomFilter)
+        bloom.capacity, bloom.error_rate = self.capacity, self.error_rate
+        bloom.bit_array_size, bloom.hash_count = self.bit_array_size, self.hash_count
+        bloom.bit_array = bytearray(self.bit_array)
+        return bloom
+
+    def popcount(self) -> int:
+        """Number of bits set."""
+        return int.from_bytes(self.bit_array, 'little').bit_count()
+
+    def fill_ratio(self) -> float:
+        """Fraction of bits set."""
+        return self.popcount() / self.bit_array_size
+
+    def estimated_count(self) -> float:
+        """Estimate of the number of distinct items added, from the fill ratio."""
+        bits_set = self.popcount()
+        if bits_set >= self.bit_array_size:
+            return math.inf
+        m, k = self.bit_array_size, self.hash_count
+        return -(m / k) * math.log(1 - bits_set / m)
+
+    def estimated_false_positive_rate(self) -> float:
+        """Current false positive probability given the fill ratio."""
+        return self.fill_ratio() ** self.hash_count
+
+    def to_bytes(self) -> bytes:
+        """Serialize the filter (geometry header followed by the packed bits)."""
+        header = self._HEADER.pack(self.capacity, self.error_rate, self.bit_array_size, self.hash_count)
+        return header + bytes(self.bit_array)
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> 'BloomFilter':
+        """Deserialize a filter produced by to_bytes."""
+        capacity, error_rate, bit_array_size, hash_count = cls._HEADER.unpack_from(data)
+        bloom = cls(capacity, error_rate)
+        if (bloom.bit_array_size, bloom.hash_count) != (bit_array_size, hash_count):
+            raise ValueError("Bloom filter header does not match its parameters")
+
+        bits = data[cls._HEADER.size:]
+        if len(bits) != len(bloom.bit_array):
+            raise ValueError("Bloom filter bit array has the wrong length")
+        bloom.bit_array = bytearray(bits)
+        return bloom
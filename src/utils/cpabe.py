@@ -0,0 +1,70 @@
+from charm.schemes.abenc.abenc_bsw07 import CPabe_BSW07
+from charm.toolbox.pairinggroup import ZR, G2
+from charm.toolbox.secretutil import SecretUtil
+from utils.cache import LRUCache
+from typing import Any, Dict, List, Tuple
+
+class CachedCPabe_BSW07(CPabe_BSW07):
+    """
+    BSW07 whose encrypt reuses the work that only depends on the policy and the MPK:
+    parsed policy trees and attribute lists (by policy with whitespace normalized), the attribute
+    hashes H(attr) in G2, and fixed-base tables for H(attr) and the MPK elements. What is left per
+    encryption is the secret sharing and its exponentiations. Ciphertexts are the same as BSW07's.
+    """
+
+    def __init__(self, group_obj, policy_cache_size: int = 256, hash_cache_size: int = 4096):
+        super().__init__(group_obj)
+        self.__group = group_obj
+        self.__util = SecretUtil(group_obj, verbose=False)
+        self.__policies = LRUCache(policy_cache_size)    # normalized policy -> (policy tree, attribute list)
+        self.__hashes = LRUCache(hash_cache_size)        # attribute -> H(attr), preprocessed
+        self.__preprocessed_pk = None
+
+    def encrypt(self, pk: Dict[str, Any], M, policy_str: str) -> Dict[str, Any]:
+        policy, a_list = self.__policy(policy_str)
+        self.__preprocess_pk(pk)
+
+        s = self.__group.random(ZR)
+        shares = self.__util.calculateSharesDict(s, policy)
+
+        C = pk['h'] ** s
+        C_y, C_y_pr = {}, {}
+        for i in shares.keys():
+            j = self.__util.strip_index(i)
+            C_y[i] = pk['g'] ** shares[i]
+            C_y_pr[i] = self.__hash(j) ** shares[i]
+
+        return {'C_tilde': (pk['e_gg_alpha'] ** s) * M,
+                'C': C, 'Cy': C_y, 'Cyp': C_y_pr, 'policy': str(policy_str), 'attributes': list(a_list)}
+
+    def clear_caches(self):
+        self.__policies.clear()
+        self.__hashes.clear()
+
+    def cache_stats(self) -> Dict[str, Dict[str, int | float]]:
+        return {"policies": self.__policies.stats(), "hashes": self.__hashes.stats()}
+
+    def __policy(self, policy_str: str) -> Tuple[Any, List[str]]:
+        key = ' '.join(policy_str.split())
+        entry = self.__policies.get(key)
+        if entry is None:
+            # Sharing only reads the tree, so one parse serves every encryption under the policy
+            policy = self.__util.createPolicy(policy_str)
+            entry = (policy, self.__util.getAttributeList(policy))
+            self.__policies.put(key, entry)
+        return entry
+
+    def __hash(self, attribute: str):
+        element = self.__hashes.get(attribute)
+        if element is None:
+            element = self.__group.hash(attribute, G2)
+            element.initPP()
+            self.__hashes.put(attribute, element)
+        return element
+
+    def __preprocess_pk(self, pk: Dict[str, Any]):
+        # Tables are built in the MPK elements themselves, once per MPK
+        if self.__preprocessed_pk is not pk:
+            for name in ('g', 'h', 'e_gg_alpha'):
+                pk[name].initPP()
+            self.__preprocessed_pk = pk
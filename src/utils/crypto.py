@@ -1,11 +1,20 @@
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 from cryptography.hazmat.primitives import padding
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.asymmetric import ec
 from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 from cryptography.hazmat.backends import default_backend
-from typing import Tuple, Any
-import os
+from typing import Tuple, Any, BinaryIO
+import os, mmap, struct
+
+# Chunked AES-GCM stream: header (magic, chunk size, nonce prefix) then one frame per chunk, each the
+# chunk's ciphertext and tag. Frame i is sealed with nonce prefix || i and, as associated data, the
+# header and a final-frame flag, so frames cannot be reordered, dropped or the stream truncated.
+STREAM_MAGIC = b'AESGCMS1'
+STREAM_HEADER = struct.Struct('>8sI8s')
+STREAM_CHUNK_SIZE = 1 << 20
+STREAM_TAG_SIZE = 16
 
 def aes_encrypt(key: bytes, message: str | bytes) -> Tuple[bytes, bytes]:
     iv = os.urandom(16)
@@ -55,4 +64,84 @@ def ecc_decrypt(private_key, package: dict[str, bytes | Any]) -> bytes:
 
     plaintext = aes_decrypt(aes_key, ct, iv)
 
-    return plaintext
\ No newline at end of file
+    return plaintext
+
+def aes_encrypt_stream(key: bytes, src_path: str | os.PathLike, dst: BinaryIO, chunk_size: int = STREAM_CHUNK_SIZE):
+    """Encrypt a file into dst as a chunked AES-GCM stream, one chunk in memory at a time."""
+    if chunk_size < 1:
+        raise ValueError("chunk_size must be positive")
+    header = STREAM_HEADER.pack(STREAM_MAGIC, chunk_size, os.urandom(8))
+    aesgcm = AESGCM(key)
+    dst.write(header)
+    with open(src_path, 'rb') as src, _map(src) as data:
+        size = len(data)
+        chunks = max(1, -(-size // chunk_size))     # An empty file still gets its final frame
+        if chunks >= 1 << 32:
+            raise ValueError("File too large for the chunk size")
+        view = memoryview(data)
+        try:
+            for i in range(chunks):
+                final = b'\x01' if i == chunks - 1 else b'\x00'
+                dst.write(aesgcm.encrypt(_stream_nonce(header, i), view[i * chunk_size:(i + 1) * chunk_size],
+                                         header + final))
+                _release(data, i * chunk_size, (i + 1) * chunk_size)
+        finally:
+            view.release()
+
+def aes_decrypt_stream(key: bytes, src: str | os.PathLike | bytes, dst: BinaryIO, offset: int = 0):
+    """
+    Decrypt a chunked AES-GCM stream starting at offset of a file (memory-mapped) or buffer into dst.
+    Raises cryptography.exceptions.InvalidTag if any frame was altered, reordered or cut off;
+    dst may then hold the plaintext of the frames before it.
+    """
+    if isinstance(src, (str, os.PathLike)):
+        with open(src, 'rb') as src_file, _map(src_file) as data:
+            _decrypt_frames(key, data, dst, offset)
+    else:
+        _decrypt_frames(key, src, dst, offset)
+
+def _decrypt_frames(key: bytes, data, dst: BinaryIO, offset: int):
+    view = memoryview(data)
+    try:
+        header = bytes(view[offset:offset + STREAM_HEADER.size])
+        if len(header) != STREAM_HEADER.size:
+            raise ValueError("Truncated stream header")
+        magic, chunk_size, _ = STREAM_HEADER.unpack(header)
+        if magic != STREAM_MAGIC:
+            raise ValueError("Not a chunked AES-GCM stream")
+
+        aesgcm = AESGCM(key)
+        frame_size = chunk_size + STREAM_TAG_SIZE
+        position, end, i = offset + STREAM_HEADER.size, len(view), 0
+        while True:
+            frame = view[position:position + frame_size]
+            start, position = position, position + len(frame)
+            final = b'\x01' if position == end else b'\x00'
+            dst.write(aesgcm.decrypt(_stream_nonce(header, i), frame, header + final))
+            _release(data, start, position)
+            if position == end:
+                break
+            i += 1
+    finally:
+        view.release()
+
+def _stream_nonce(header: bytes, index: int) -> bytes:
+    return header[-8:] + index.to_bytes(4, 'big')
+
+def _map(file: BinaryIO):
+    # Empty files cannot be mapped
+    if os.fstat(file.fileno()).st_size == 0:
+        return memoryview(b'')
+    data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    if hasattr(mmap, 'MADV_SEQUENTIAL'):
+        data.madvise(mmap.MADV_SEQUENTIAL)
+    return data
+
+def _release(data, start: int, end: int):
+    # Drop the mapped pages of a processed chunk, so resident memory stays at about one chunk
+    if isinstance(data, mmap.mmap) and hasattr(mmap, 'MADV_DONTNEED'):
+        start -= start % mmap.PAGESIZE
+        end = min(end, len(data))
+        end -= end % mmap.PAGESIZE
+        if end > start:
+            data.madvise(mmap.MADV_DONTNEED, start, end - start)
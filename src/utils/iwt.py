@@ -1,58 +1,440 @@
-from typing import Set, List, Optional, Dict, Tuple
+from typing import Set, List, Optional, Dict, Tuple, Iterator
 from collections import defaultdict
 from utils.bloom import BloomFilter
+from utils.postings import FileIdDictionary, union_all, iter_distinct
+from utils.metrics import RequestStats
+import itertools, contextlib, copy, threading
+from pyroaring import BitMap
+
+def trailing_star_head(pattern: List[str]) -> int:
+    """Length of the pattern without its trailing run of '*'."""
+    head = len(pattern)
+    while head > 0 and pattern[head - 1] == '*':
+        head -= 1
+    return head
+
+class SummaryPolicy:
+    """Decides which trie nodes keep a Bloom filter summary of the words in their subtree."""
+
+    def __init__(self, every: Optional[int]):
+        # every=None: no summaries, every=0: root only, every=N: every Nth depth (root included)
+        if every is not None and every < 0:
+            raise ValueError("every must be None, 0 or a positive depth interval")
+        self.every = every
+
+    @classmethod
+    def root_only(cls) -> 'SummaryPolicy':
+        return cls(0)
+
+    @classmethod
+    def every_nth_depth(cls, n: int) -> 'SummaryPolicy':
+        if n < 1:
+            raise ValueError("n must be positive")
+        return cls(n)
+
+    @classmethod
+    def disabled(cls) -> 'SummaryPolicy':
+        return cls(None)
+
+    def covers(self, depth: int) -> bool:
+        """Whether a node at the given depth keeps a summary."""
+        if self.every is None:
+            return False
+        if self.every == 0:
+            return depth == 0
+        return depth % self.every == 0
 
 # BY CLAUDE AI
 class TrieNode:
-    """Node in the prefix trie with Bloom filter and file references."""
+    """Node in the prefix trie with an optional Bloom filter summary and file postings."""
     
+    # Headroom when sizing a summary, so it survives some inserts before being rebuilt
+    SUMMARY_HEADROOM = 2
+    SUMMARY_ERROR_RATE = 0.01
+
     def __init__(self):
         self.children: Dict[str, 'TrieNode'] = {}
         self.is_end_of_word = False
-        self.bloom_filter = BloomFilter(capacity=1000, error_rate=0.01)
-        self.file_references: Set[str] = set()
+        self.bloom_filter: Optional[BloomFilter] = None     # Created lazily, see build_summary
+        self.word_count = 0     # Distinct words in this subtree
+        self.file_postings = BitMap()       # Ids of the files containing this word
+        self.subtree_postings = BitMap()    # Union of file_postings over this subtree
+        self._shared_postings = False       # Both postings still belong to the node this one was copied from
         
+    def copy(self) -> 'TrieNode':
+        """
+        Copy for copy-on-write updates. Children and postings are shared with the original
+        until the copy changes them; so is the summary, see add_word_to_subtree.
+        """
+        node = TrieNode.__new__(TrieNode)
+        node.children = dict(self.children)
+        node.is_end_of_word = self.is_end_of_word
+        node.bloom_filter = self.bloom_filter
+        node.word_count = self.word_count
+        node.file_postings = self.file_postings
+        node.subtree_postings = self.subtree_postings
+        node._shared_postings = True
+        return node
+    
+    def __own_postings(self):
+        # Copy the shared postings before the first change
+        if self._shared_postings:
+            self.file_postings = BitMap(self.file_postings)
+            self.subtree_postings = BitMap(self.subtree_postings)
+            self._shared_postings = False
+
     def add_word_to_subtree(self, word: List[str]):
-        """Add a word to the Bloom filter representing all words in this subtree."""
-        self.bloom_filter.add(word[-1])
+        """
+        Count a new word in this subtree and keep an existing Bloom filter up to date.
+        The filter is updated in place even when shared with older versions: bits are only
+        ever set, so those versions merely get false positives, which their trie walk rejects.
+        """
+        self.word_count += 1
+        if self.bloom_filter is None:
+            return
+
+        if self.word_count > self.bloom_filter.capacity:
+            # Outgrown: drop it and let the next lookup rebuild it at the right size
+            self.bloom_filter = None
+        else:
+            self.bloom_filter.add(word[-1])
     
-    def add_file_reference(self, filename: str):
-        """Add a file reference to this node."""
-        self.file_references.add(filename)
+    def remove_word_from_subtree(self):
+        """Uncount a removed word. Bloom filters cannot forget, the stale bits only cost false positives."""
+        self.word_count -= 1
+    
+    def add_file(self, file_id: int):
+        """Add a file id to this node."""
+        if file_id not in self.file_postings:
+            self.__own_postings()
+            self.file_postings.add(file_id)
+    
+    def discard_file(self, file_id: int):
+        """Remove a file id from this node."""
+        if file_id in self.file_postings:
+            self.__own_postings()
+            self.file_postings.discard(file_id)
+    
+    def add_subtree_file(self, file_id: int):
+        """Add a file id to the subtree postings."""
+        if file_id not in self.subtree_postings:
+            self.__own_postings()
+            self.subtree_postings.add(file_id)
+    
+    def discard_subtree_file(self, file_id: int):
+        """Remove a file id from the subtree postings."""
+        if file_id in self.subtree_postings:
+            self.__own_postings()
+            self.subtree_postings.discard(file_id)
+    
+    def build_summary(self) -> BloomFilter:
+        """Create the Bloom filter sized from the subtree cardinality and fill it with the subtree's words."""
+        bloom = BloomFilter(capacity=max(1, self.word_count * self.SUMMARY_HEADROOM),
+                            error_rate=self.SUMMARY_ERROR_RATE)
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            for char, child in node.children.items():
+                if child.is_end_of_word:
+                    bloom.add(char)
+                stack.append(child)
+
+        self.bloom_filter = bloom
+        return bloom
     
     def might_contain_word(self, word: List[str]) -> bool:
         """Check if the subtree rooted at this node might contain the word."""
-        return self.bloom_filter.contains(word[-1])
+        bloom = self.bloom_filter if self.bloom_filter is not None else self.build_summary()
+        return bloom.contains(word[-1])
+
+class IWTDelta:
+    """
+    Batched update of an IWT from base_version to version.
+    Applied in order: removed files, removed (word, file) pairs, inserted (word, file) pairs.
+    """
+    
+    def __init__(self, base_version: int, version: int,
+                 insertions: Optional[List[Tuple[List[str], str]]] = None,
+                 removals: Optional[List[Tuple[List[str], str]]] = None,
+                 removed_files: Optional[List[str]] = None):
+        self.base_version = base_version
+        self.version = version
+        self.insertions = insertions if insertions is not None else []
+        self.removals = removals if removals is not None else []
+        self.removed_files = removed_files if removed_files is not None else []
 
 class IndexWildcardTree:
-    """Prefix trie implementation with Bloom filters for efficient word lookups."""
+    """
+    Prefix trie implementation with Bloom filters for efficient word lookups.
+
+    Updates are copy-on-write: they copy the nodes on their path into a draft tree and
+    publish its root and version together, so a published node is never modified and
+    searches never need a lock. Every search reads the version published when it started.
+    """
     
-    def __init__(self):
-        self.root = TrieNode()
-        self.word_to_files: Dict[str, Set[str]] = defaultdict(set)
+    def __init__(self, summary_policy: Optional[SummaryPolicy] = None):
+        self.summary_policy = summary_policy if summary_policy is not None else SummaryPolicy.root_only()
+        self.file_ids = FileIdDictionary()      # Append-only, shared by all versions
+        self.word_to_files: Dict[str, BitMap] = defaultdict(BitMap)     # Values are replaced, never modified
+        self.__published: Tuple[TrieNode, int] = (TrieNode(), 0)   # (root, version), bumped by every update
+        self.__read_only = False
+        self.__write_lock = threading.RLock()
+        # State of the open transaction
+        self.__draft_root: Optional[TrieNode] = None
+        self.__draft_version = 0
+        self.__draft_nodes: Dict[int, TrieNode] = {}    # Nodes copied or created by it, by id
+        self.__draft_words: Dict[str, BitMap] = {}
+    
+    @property
+    def root(self) -> TrieNode:
+        """Root of the published version."""
+        return self.__published[0]
+    
+    @property
+    def version(self) -> int:
+        return self.__published[1]
+    
+    @version.setter
+    def version(self, version: int):
+        with self.__write_lock:
+            self.__published = (self.__published[0], version)
+    
+    def snapshot(self) -> 'IndexWildcardTree':
+        """
+        Read-only view pinned to the published version; later updates are not visible through its searches.
+        Only the trie and its postings are pinned. The file id dictionary stays shared, which is safe since
+        it is append-only. The word-to-files mapping is updated in place, so a view does not expose it.
+        """
+        view = copy.copy(self)
+        view.__read_only = True
+        view.word_to_files = None
+        return view
+    
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        Publish several updates as one version, all at once. Searches keep reading the
+        previous version meanwhile. If the block raises, nothing is published.
+        Transactions of different threads run one after the other; nested ones join the outer one.
+        """
+        if self.__read_only:
+            raise Exception("IWT snapshot is read-only")
+        
+        with self.__write_lock:
+            if self.__draft_root is not None:
+                yield self
+                return
+            
+            root, version = self.__published
+            self.__draft_root = root.copy()
+            self.__draft_version = version
+            self.__draft_nodes = {id(self.__draft_root): self.__draft_root}
+            try:
+                yield self
+                if self.__draft_version != version:
+                    for token, postings in self.__draft_words.items():
+                        if postings:
+                            self.word_to_files[token] = postings
+                        else:
+                            self.word_to_files.pop(token, None)
+                    self.__published = (self.__draft_root, self.__draft_version)
+            finally:
+                self.__draft_root = None
+                self.__draft_nodes = {}
+                self.__draft_words = {}
+    
+    def __new_node(self, parent: TrieNode, char: str) -> TrieNode:
+        node = parent.children[char] = TrieNode()
+        self.__draft_nodes[id(node)] = node
+        return node
+    
+    def __writable(self, parent: TrieNode, char: str) -> Optional[TrieNode]:
+        """Child of a draft node, copied into the draft the first time it is written."""
+        child = parent.children.get(char)
+        if child is None or id(child) in self.__draft_nodes:
+            return child
+        child = parent.children[char] = child.copy()
+        self.__draft_nodes[id(child)] = child
+        return child
+    
+    def __word_postings(self, token: str) -> BitMap:
+        """Draft copy of the word-to-files postings of a token."""
+        postings = self.__draft_words.get(token)
+        if postings is None:
+            postings = self.__draft_words[token] = BitMap(self.word_to_files.get(token, ()))
+        return postings
     
     def insert(self, word: List[str], filename: str):
         """Insert a word into the trie with its associated file reference."""
         if not word:
             return
         
-        # Add word to all nodes along the path (for Bloom filters)
-        current = self.root
-        current.add_word_to_subtree(word)
+        with self.transaction():
+            self._insert(word, filename)
+            self.__draft_version += 1
+    
+    def _insert(self, word: List[str], filename: str):
+        # Called in a transaction
+        current = self.__draft_root
+        path = [current]
         for char in word:
-            if char not in current.children:
-                current.children[char] = TrieNode()
-            current = current.children[char]
+            child = self.__writable(current, char)
+            current = child if child is not None else self.__new_node(current, char)
+            path.append(current)
         
+        # Count a new word in every subtree along the path (sizes the Bloom filters)
+        if not current.is_end_of_word:
+            for node in path:
+                node.add_word_to_subtree(word)
+
+        # Keep the aggregated subtree postings up to date
+        file_id = self.file_ids.encode(filename)
+        if file_id not in current.file_postings:
+            for node in path:
+                node.add_subtree_file(file_id)
+
         # Mark end of word and add file reference
         current.is_end_of_word = True
-        current.add_file_reference(filename)
+        current.add_file(file_id)
         
         # Update word-to-files mapping
-        self.word_to_files[word[-1]].add(filename)
+        self.__word_postings(word[-1]).add(file_id)
+    
+    def remove(self, word: List[str], filename: str) -> bool:
+        """Remove a file reference from a word, pruning nodes left empty. Returns whether it was present."""
+        file_id = self.file_ids.lookup(filename)
+        if not word or file_id is None:
+            return False
+        
+        with self.transaction():
+            removed = self._remove(word, file_id)
+            if removed:
+                self.__draft_version += 1
+        return removed
+    
+    def remove_file(self, filename: str) -> int:
+        """Remove a file from every word that references it. Returns the number of words affected."""
+        file_id = self.file_ids.lookup(filename)
+        if file_id is None:
+            return 0
+        
+        with self.transaction():
+            removed = self._remove_file(file_id)
+            if removed:
+                self.__draft_version += 1
+        return removed
+    
+    def _remove_file(self, file_id: int) -> int:
+        # Called in a transaction
+        if file_id not in self.__draft_root.subtree_postings:
+            return 0
+        
+        # Only descend into subtrees whose aggregated postings hold the file
+        words = []
+        stack = [(self.__draft_root, [])]
+        while stack:
+            node, word = stack.pop()
+            if node.is_end_of_word and file_id in node.file_postings:
+                words.append(word)
+            for char, child in node.children.items():
+                if file_id in child.subtree_postings:
+                    stack.append((child, word + [char]))
+        
+        for word in words:
+            self._remove(word, file_id)
+        return len(words)
+    
+    def _remove(self, word: List[str], file_id: int) -> bool:
+        # Called in a transaction. Look the word up before copying anything
+        current = self.__draft_root
+        for char in word:
+            current = current.children.get(char)
+            if current is None:
+                return False
+        
+        if not current.is_end_of_word or file_id not in current.file_postings:
+            return False
+        
+        current = self.__draft_root
+        path = [current]
+        for char in word:
+            current = self.__writable(current, char)
+            path.append(current)
+        
+        current.discard_file(file_id)
+        self.__word_postings(word[-1]).discard(file_id)
+        
+        if not current.file_postings:
+            current.is_end_of_word = False
+            for node in path:
+                node.remove_word_from_subtree()
+        
+        # Refresh the subtree postings bottom-up, until an ancestor still reaches the file elsewhere
+        for node in reversed(path):
+            if file_id in node.file_postings or any(file_id in child.subtree_postings
+                                                    for child in node.children.values()):
+                break
+            node.discard_subtree_file(file_id)
+        
+        # Prune the nodes that no longer lead to any word
+        for depth in range(len(path) - 1, 0, -1):
+            node = path[depth]
+            if node.children or node.is_end_of_word:
+                break
+            del path[depth - 1].children[word[depth - 1]]
+        
+        return True
+    
+    def apply_delta(self, delta: 'IWTDelta'):
+        """
+        Apply a delta produced against this tree's current version.
+        The whole delta is published as one version, and a rejected delta leaves the tree untouched.
+        """
+        with self.transaction():
+            if delta.base_version != self.__draft_version:
+                raise ValueError(f"Stale IWT delta: based on version {delta.base_version}, tree is at {self.__draft_version}")
+            if delta.version <= delta.base_version:
+                raise ValueError("IWT delta version must be newer than its base version")
+            for word, filename in delta.insertions + delta.removals:
+                if not word or not isinstance(filename, str):
+                    raise ValueError("Malformed IWT delta entry")
+            
+            for filename in delta.removed_files:
+                file_id = self.file_ids.lookup(filename)
+                if file_id is not None:
+                    self._remove_file(file_id)
+            for word, filename in delta.removals:
+                file_id = self.file_ids.lookup(filename)
+                if file_id is not None:
+                    self._remove(word, file_id)
+            for word, filename in delta.insertions:
+                self._insert(word, filename)
+            
+            self.__draft_version = delta.version
+    
+    def _might_contain(self, node: TrieNode, depth: int, word: List[str]) -> bool:
+        """Bloom filter check at a node. Nodes outside the summary policy always answer 'maybe'."""
+        if not self.summary_policy.covers(depth):
+            return True
+        return node.might_contain_word(word)
+    
+    def build_summaries(self):
+        """Eagerly build the Bloom filters of all nodes covered by the summary policy."""
+        stack = [(self.root, 0)]
+        while stack:
+            node, depth = stack.pop()
+            if self.summary_policy.covers(depth) and node.bloom_filter is None:
+                node.build_summary()
+            for child in node.children.values():
+                stack.append((child, depth + 1))
     
     def search(self, word: List[str]) -> Optional[Set[str]]:
         """Search for a word and return the files that contain it."""
+        postings = self.search_postings(word)
+        return self.file_ids.to_refs(postings) if postings is not None else None
+    
+    def search_postings(self, word: List[str]) -> Optional[BitMap]:
+        """Search for a word and return the ids of the files that contain it."""
         if not word:
             return None
             
@@ -66,7 +448,7 @@ class IndexWildcardTree:
         
         # Check if it's a complete word
         if node.is_end_of_word:
-            return node.file_references.copy()
+            return BitMap(node.file_postings)
         
         return None
     
@@ -103,7 +485,7 @@ class IndexWildcardTree:
         using the Bloom filter for fast probabilistic checking.
         """
         if not prefix:
-            return self.root.might_contain_word(target_word)
+            return self._might_contain(self.root, 0, target_word)
             
         prefix = prefix.lower()
         target_word = target_word.lower()
@@ -116,7 +498,7 @@ class IndexWildcardTree:
             node = node.children[char]
         
         # Check if the subtree might contain the target word
-        return node.might_contain_word(target_word)
+        return self._might_contain(node, len(prefix), target_word)
     
     def get_files_for_prefix(self, prefix: str) -> Set[str]:
         """Get all files that contain words starting with the given prefix."""
@@ -132,21 +514,24 @@ class IndexWildcardTree:
                 return set()
             node = node.children[char]
         
-        # Collect all file references from this subtree
-        files = set()
-        self._collect_files(node, files)
-        return files
-    
-    def _collect_files(self, node: TrieNode, files: Set[str]):
-        """Helper method to collect all file references from a subtree."""
-        files.update(node.file_references)
-        
-        for child_node in node.children.values():
-            self._collect_files(child_node, files)
+        # All file references of this subtree are kept aggregated on the node
+        return self.file_ids.to_refs(node.subtree_postings)
     
     def get_word_files_mapping(self) -> Dict[str, Set[str]]:
-        """Get the complete mapping of words to files."""
-        return dict(self.word_to_files)
+        """Get the complete mapping of words to files. Not available on a snapshot, see snapshot()."""
+        if self.__read_only:
+            raise Exception("IWT snapshot has no word-to-files mapping, read it from the live tree")
+        return {word: self.file_ids.to_refs(postings) for word, postings in list(self.word_to_files.items())}
+    
+    def node_count(self) -> int:
+        """Number of nodes in the trie, root included."""
+        count = 0
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            count += 1
+            stack.extend(node.children.values())
+        return count
     
     def wildcard_search(self, pattern: List[str]) -> Dict[str, Set[str]]:
         """
@@ -159,43 +544,74 @@ class IndexWildcardTree:
             return {}
             
         results = {}
-        self._wildcard_search_helper(self.root, pattern, 0, [], results)
+        for char, node in self._match_nodes(pattern):
+            results[char] = self.file_ids.to_refs(node.file_postings)
         return results
     
-    def _wildcard_search_helper(self, node: TrieNode, pattern: List[str], pattern_idx: int, 
-                               current_word: List[str], results: Dict[str, Set[str]]):
+    def _match_nodes(self, pattern: List[str], words_only: bool = True,
+                     start: Optional[TrieNode] = None,
+                     stats: Optional[RequestStats] = None) -> List[Tuple[str, TrieNode]]:
         """
-        Helper method for wildcard search using backtracking.
+        Simulate the pattern as an NFA over trie nodes and return the nodes reached at the end
+        of the pattern (only word nodes if words_only) with the token leading to them.
+        A state is (node, pattern index). Each state is pushed at most once, so several
+        stars cannot revisit the same subtree and deep tries cannot hit the recursion limit.
+        With stats, the states visited and the children expanded by wildcards are counted.
         """
-        # Base case: we've processed the entire pattern
-        if pattern_idx == len(pattern):
-            if node.is_end_of_word:
-                results[current_word[-1]] = node.file_references.copy()
-            return
-        
-        char = pattern[pattern_idx]
-        
-        if char == '*':
-            # '*' can match zero characters (skip the *)
-            self._wildcard_search_helper(node, pattern, pattern_idx + 1, current_word, results)
-            
-            # '*' can match one or more characters
-            for child_char, child_node in node.children.items():
-                # Try matching one character and continue with *
-                self._wildcard_search_helper(child_node, pattern, pattern_idx, 
-                                           current_word + [child_char], results)
-        
-        elif char == '?':
-            # '?' matches exactly one character
-            for child_char, child_node in node.children.items():
-                self._wildcard_search_helper(child_node, pattern, pattern_idx + 1,
-                                           current_word + [child_char], results)
-        
-        else:
-            # Regular character matching
-            if char in node.children:   # Change to Bloom filter?
-                self._wildcard_search_helper(node.children[char], pattern, pattern_idx + 1,
-                                           current_word + [char], results)
+        return list(self._iter_match_nodes(pattern, words_only, start, stats))
+
+    def _iter_match_nodes(self, pattern: List[str], words_only: bool = True,
+                          start: Optional[TrieNode] = None,
+                          stats: Optional[RequestStats] = None) -> Iterator[Tuple[str, TrieNode]]:
+        """_match_nodes as a generator: the traversal only advances as far as the caller reads."""
+        start = start if start is not None else self.root
+        end = len(pattern)
+        stack = [(start, '', 0)]
+        visited = {(id(start), 0)}
+        branches = 0     # Children expanded by '*' and '?'
+
+        try:
+            while stack:
+                node, token, pattern_idx = stack.pop()
+
+                if pattern_idx == end:
+                    if node.is_end_of_word or not words_only:
+                        yield (token, node)
+                    continue
+
+                char = pattern[pattern_idx]
+
+                if char == '*':
+                    # '*' can match zero characters
+                    if (id(node), pattern_idx + 1) not in visited:
+                        visited.add((id(node), pattern_idx + 1))
+                        stack.append((node, token, pattern_idx + 1))
+
+                    # '*' can match one or more characters
+                    branches += len(node.children)
+                    for child_char, child_node in node.children.items():
+                        if (id(child_node), pattern_idx) not in visited:
+                            visited.add((id(child_node), pattern_idx))
+                            stack.append((child_node, child_char, pattern_idx))
+
+                elif char == '?':
+                    # '?' matches exactly one character
+                    branches += len(node.children)
+                    for child_char, child_node in node.children.items():
+                        if (id(child_node), pattern_idx + 1) not in visited:
+                            visited.add((id(child_node), pattern_idx + 1))
+                            stack.append((child_node, child_char, pattern_idx + 1))
+
+                else:
+                    # Regular character matching
+                    child_node = node.children.get(char)
+                    if child_node is not None and (id(child_node), pattern_idx + 1) not in visited:
+                        visited.add((id(child_node), pattern_idx + 1))
+                        stack.append((child_node, char, pattern_idx + 1))
+        finally:
+            if stats is not None:
+                stats.count('trie_nodes_visited', len(visited))
+                stats.count('wildcard_branches', branches)
     
     def bloom_optimized_exact_search(self, word: str) -> bool:
         """
@@ -208,7 +624,7 @@ class IndexWildcardTree:
         word = word.lower()
         
         # Use root's Bloom filter to quickly check if word might exist
-        if not self.root.might_contain_word(word):
+        if not self._might_contain(self.root, 0, word):
             return False
         
         # If Bloom filter says it might exist, do the actual search
@@ -269,46 +685,278 @@ class IndexWildcardTree:
     
     # MAIN ONE
     def wildcard_files_only(self, 
-                            pattern: List[str]):
+                            pattern: List[str],
+                            limit: Optional[int] = None):
         """
         Get only the files that contain words matching the wildcard pattern.
         More efficient when you only need file references, not the actual words.
+        With a limit, the traversal stops as soon as that many files are found.
         """
-        if not pattern:
-            return set()
-            
-        files = set()
-        self._wildcard_files_helper(self.root, pattern, 0, files)
-        return files
+        if limit is not None:
+            return {self.file_ids.decode(file_id)
+                    for file_id in itertools.islice(self.iter_wildcard_file_ids(pattern), limit)}
+        return self.file_ids.to_refs(self.wildcard_postings(pattern))
     
-    def _wildcard_files_helper(self, node: TrieNode, pattern: List[str], pattern_idx: int, 
-                              files: Set[str]):
-        """Helper method to collect only file references from wildcard matches."""
-        if pattern_idx == len(pattern):
-            if node.is_end_of_word:
-                # print(f"\nCS found {node.file_references}")
-                files.update(node.file_references)
-            return
+    def wildcard_postings(self, pattern: List[str], stats: Optional[RequestStats] = None) -> BitMap:
+        """Ids of the files that contain words matching the wildcard pattern."""
+        if not pattern:
+            return BitMap()
         
-        char = pattern[pattern_idx]
+        return self._postings_from(self.root, pattern, stats)
+    
+    def iter_wildcard_file_ids(self, pattern: List[str], stats: Optional[RequestStats] = None) -> Iterator[int]:
+        """Ids of the files matching the wildcard pattern, each once, found lazily as the trie is traversed."""
+        if not pattern:
+            return iter(())
+
+        head = trailing_star_head(pattern)
+        if head < len(pattern):
+            return iter_distinct(match.subtree_postings
+                                 for _, match in self._iter_match_nodes(pattern[:head], False, self.root, stats))
+        return iter_distinct(match.file_postings
+                             for _, match in self._iter_match_nodes(pattern, True, self.root, stats))
+
+    def wildcard_postings_many(self, patterns: List[List[str]],
+                               stats: Optional[RequestStats] = None) -> Dict[Tuple[str, ...], BitMap]:
+        """
+        Evaluate several wildcard patterns in one pass, keyed by tuple(pattern).
+        Identical patterns are evaluated once, and the literal prefix shared by several
+        patterns (the tokens before their first wildcard) is walked once.
+        """
+        results: Dict[Tuple[str, ...], BitMap] = {}
+        walked: Dict[str, Tuple[Optional[TrieNode], Dict]] = {}     # Literal prefixes already walked, as a nested map
         
-        if char == '*':
-            # '*' can match zero characters
-            self._wildcard_files_helper(node, pattern, pattern_idx + 1, files)
+        for pattern in patterns:
+            key = tuple(pattern)
+            if key in results:
+                continue
+            if not pattern:
+                results[key] = BitMap()
+                continue
             
-            # '*' can match one or more characters
-            for child_node in node.children.values():
-                self._wildcard_files_helper(child_node, pattern, pattern_idx, files)
-        
-        elif char == '?':
-            # '?' matches exactly one character
-            for child_node in node.children.values():
-                self._wildcard_files_helper(child_node, pattern, pattern_idx + 1, files)
+            node, level, i = self.root, walked, 0
+            while node is not None and i < len(pattern) and pattern[i] not in ('*', '?'):
+                entry = level.get(pattern[i])
+                if entry is None:
+                    entry = level[pattern[i]] = (node.children.get(pattern[i]), {})
+                node, level = entry
+                i += 1
+            
+            results[key] = self._postings_from(node, pattern[i:], stats) if node is not None else BitMap()
         
-        else:
-            # Regular character matching
-            if char in node.children:
-                self._wildcard_files_helper(node.children[char], pattern, pattern_idx + 1, files)
+        return results
+    
+    def _postings_from(self, node: TrieNode, pattern: List[str], stats: Optional[RequestStats] = None) -> BitMap:
+        """File ids of the words below node matching the rest of a pattern."""
+        # Trailing '*' matches any suffix: every node reached by the rest of the
+        # pattern contributes its whole subtree, which is already aggregated
+        head = trailing_star_head(pattern)
+        if head < len(pattern):
+            return union_all(match.subtree_postings
+                             for _, match in self._match_nodes(pattern[:head], False, node, stats))
+        return union_all(match.file_postings for _, match in self._match_nodes(pattern, True, node, stats))
+
+class RadixTrieNode:
+    """Node in the path-compressed trie. The incoming edge holds a run of tokens."""
+
+    __slots__ = ('edge', 'children', 'is_end_of_word', 'file_postings', 'subtree_postings')
+
+    def __init__(self, edge: Tuple[str, ...] = ()):
+        self.edge = edge
+        self.children: Dict[str, 'RadixTrieNode'] = {}   # keyed by the first token of the child's edge
+        self.is_end_of_word = False
+        self.file_postings = BitMap()       # Ids of the files containing this word
+        self.subtree_postings = BitMap()    # Union of file_postings over this subtree
+
+class RadixIndexWildcardTree:
+    """
+    Path-compressed variant of IndexWildcardTree.
+    Every trapdoor token is an HMAC of a distinct prefix, so the tail of each keyword
+    is a chain of single-child nodes. Here such chains are collapsed into one edge
+    holding the token sequence; insert, search and wildcard_files_only behave
+    exactly as in IndexWildcardTree.
+    """
+
+    def __init__(self):
+        self.root = RadixTrieNode()
+        self.bloom_filter: Optional[BloomFilter] = None     # Root summary, created lazily
+        self.file_ids = FileIdDictionary()
+        self.word_to_files: Dict[str, BitMap] = defaultdict(BitMap)
+
+    def insert(self, word: List[str], filename: str):
+        """Insert a word into the trie with its associated file reference."""
+        if not word:
+            return
+
+        if self.bloom_filter is not None and word[-1] not in self.word_to_files:
+            if len(self.word_to_files) >= self.bloom_filter.capacity:
+                self.bloom_filter = None
+            else:
+                self.bloom_filter.add(word[-1])
+
+        node = self.root
+        path = [node]
+        i = 0
+        while i < len(word):
+            child = node.children.get(word[i])
+            if child is None:
+                # Remaining tokens become a single new edge
+                child = RadixTrieNode(tuple(word[i:]))
+                node.children[word[i]] = child
+                node = child
+                path.append(node)
+                break
+
+            # Length of the common prefix of the edge and the rest of the word
+            edge = child.edge
+            limit = min(len(edge), len(word) - i)
+            k = 1
+            while k < limit and edge[k] == word[i + k]:
+                k += 1
+
+            if k < len(edge):
+                # Split the edge at the first mismatching token
+                middle = RadixTrieNode(edge[:k])
+                middle.subtree_postings = BitMap(child.subtree_postings)
+                child.edge = edge[k:]
+                middle.children[child.edge[0]] = child
+                node.children[word[i]] = middle
+                child = middle
+
+            node = child
+            path.append(node)
+            i += k
+
+        file_id = self.file_ids.encode(filename)
+        if file_id not in node.file_postings:
+            for path_node in path:
+                path_node.subtree_postings.add(file_id)
+
+        node.is_end_of_word = True
+        node.file_postings.add(file_id)
+        self.word_to_files[word[-1]].add(file_id)
+
+    def search(self, word: List[str]) -> Optional[Set[str]]:
+        """Search for a word and return the files that contain it."""
+        if not word:
+            return None
+
+        node, offset = self.root, 0
+        for char in word:
+            position = self._follow(node, offset, char)
+            if position is None:
+                return None
+            node, offset = position
+
+        if offset == len(node.edge) and node.is_end_of_word:
+            return self.file_ids.to_refs(node.file_postings)
+
+        return None
+
+    def might_contain_word(self, word: List[str]) -> bool:
+        """Check the root Bloom filter, sizing it from the number of distinct words on first use."""
+        if self.bloom_filter is None:
+            self.bloom_filter = BloomFilter(capacity=max(1, len(self.word_to_files) * TrieNode.SUMMARY_HEADROOM),
+                                            error_rate=TrieNode.SUMMARY_ERROR_RATE)
+            self.bloom_filter.add_many(self.word_to_files)
+        return self.bloom_filter.contains(word[-1])
+
+    def get_word_files_mapping(self) -> Dict[str, Set[str]]:
+        """Get the complete mapping of words to files."""
+        return {word: self.file_ids.to_refs(postings) for word, postings in self.word_to_files.items()}
+
+    def node_count(self) -> int:
+        """Number of nodes in the trie, root included."""
+        count = 0
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            count += 1
+            stack.extend(node.children.values())
+        return count
+
+    # A position is (node, offset): the first `offset` tokens of node.edge have been consumed.
+    # offset == len(node.edge) means the position is at the node itself.
+    def _follow(self, node: RadixTrieNode, offset: int, char: str) -> Optional[Tuple[RadixTrieNode, int]]:
+        """Advance a position by one specific token."""
+        if offset < len(node.edge):
+            return (node, offset + 1) if node.edge[offset] == char else None
+
+        child = node.children.get(char)
+        return (child, 1) if child is not None else None
+
+    def wildcard_files_only(self, pattern: List[str]) -> Set[str]:
+        """
+        Get only the files that contain words matching the wildcard pattern.
+        * matches zero or more tokens, ? matches exactly one token.
+        """
+        return self.file_ids.to_refs(self.wildcard_postings(pattern))
+
+    def wildcard_postings(self, pattern: List[str]) -> BitMap:
+        """Ids of the files that contain words matching the wildcard pattern."""
+        if not pattern:
+            return BitMap()
+
+        # Trailing '*': the subtree below every position reached by the head matches
+        head = trailing_star_head(pattern)
+        if head < len(pattern):
+            return union_all(node.subtree_postings for node in self._match_nodes(pattern[:head], words_only=False))
+        return union_all(node.file_postings for node in self._match_nodes(pattern))
+
+    def _match_nodes(self, pattern: List[str], words_only: bool = True) -> List[RadixTrieNode]:
+        """
+        Simulate the pattern as an NFA over trie positions and return the word nodes accepted
+        at the end of the pattern. With words_only=False, every position reached at the end is
+        returned as its node (a position inside an edge has the same subtree as the node).
+        A state is (node, offset, pattern index) and is expanded at most once.
+        """
+        end = len(pattern)
+        accepted = []
+        stack = [(self.root, 0, 0)]
+        visited = {(id(self.root), 0, 0)}
+
+        def push(node: RadixTrieNode, offset: int, pattern_idx: int):
+            key = (id(node), offset, pattern_idx)
+            if key not in visited:
+                visited.add(key)
+                stack.append((node, offset, pattern_idx))
+
+        while stack:
+            node, offset, pattern_idx = stack.pop()
+
+            if pattern_idx == end:
+                if not words_only or (offset == len(node.edge) and node.is_end_of_word):
+                    accepted.append(node)
+                continue
+
+            char = pattern[pattern_idx]
+
+            if char == '*':
+                # '*' can match zero tokens
+                push(node, offset, pattern_idx + 1)
+
+                # '*' can match one or more tokens
+                if offset < len(node.edge):
+                    push(node, offset + 1, pattern_idx)
+                else:
+                    for child in node.children.values():
+                        push(child, 1, pattern_idx)
+
+            elif char == '?':
+                # '?' matches exactly one token
+                if offset < len(node.edge):
+                    push(node, offset + 1, pattern_idx + 1)
+                else:
+                    for child in node.children.values():
+                        push(child, 1, pattern_idx + 1)
+
+            else:
+                # Regular token matching
+                position = self._follow(node, offset, char)
+                if position is not None:
+                    push(position[0], position[1], pattern_idx + 1)
+
+        return accepted
 
 # Example usage and testing
 if __name__ == "__main__":
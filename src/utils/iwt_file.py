@@ -0,0 +1,350 @@
+"""
+On-disk IWT format (little-endian):
+
+    header      magic, format version, counts and section offsets (HEADER)
+    nodes       one fixed-size record per node (NODE), breadth-first, so the children of a
+                node are contiguous and sorted by encoded token
+    tokens      incoming-edge token of every node; 64-char hex trapdoor tokens are packed
+                to their 32 raw bytes, anything else is stored as UTF-8
+    postings    serialized roaring bitmaps; identical subtree postings (single-child chains,
+                leaves) point to the same block
+    file refs   file_count+1 u64 offsets followed by the UTF-8 references, in file id order
+"""
+import itertools, mmap, os, struct
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+from pyroaring import BitMap
+from utils.iwt import IndexWildcardTree, TrieNode, trailing_star_head
+from utils.postings import union_all, iter_distinct
+from utils.metrics import RequestStats
+
+MAGIC = b'IWTFILE\0'
+FORMAT_VERSION = 1
+
+# magic, format version, node count, file count, iwt version,
+# tokens offset, postings offset, file refs offset
+HEADER = struct.Struct('<8sIIIQQQQ')
+
+# token offset, token length, first child, child count,
+# postings offset, postings length, subtree postings offset, subtree postings length, flags
+NODE = struct.Struct('<QIIIQIQIB3x')
+
+FLAG_END_OF_WORD = 1
+FLAG_HEX_TOKEN = 2
+
+_HEX_DIGITS = frozenset('0123456789abcdef')
+
+def _encode_token(token: str) -> Tuple[int, bytes]:
+    """Sort key and stored form of a token: (hex flag, bytes)."""
+    if len(token) == 64 and _HEX_DIGITS.issuperset(token):
+        return (FLAG_HEX_TOKEN, bytes.fromhex(token))
+    return (0, token.encode())
+
+def _decode_token(flags: int, data: bytes) -> str:
+    return data.hex() if flags & FLAG_HEX_TOKEN else data.decode()
+
+def write_iwt(iwt: IndexWildcardTree, path: str | os.PathLike):
+    """Save an IndexWildcardTree to path. The file is written aside and renamed into place."""
+    iwt = iwt.snapshot()    # Updates may land while the file is written
+    # Breadth-first numbering, children sorted by encoded token
+    nodes: List[Tuple[TrieNode, Tuple[int, bytes]]] = [(iwt.root, (0, b''))]
+    first_child: List[int] = []
+    i = 0
+    while i < len(nodes):
+        node = nodes[i][0]
+        first_child.append(len(nodes))
+        nodes.extend(sorted(((child, _encode_token(char)) for char, child in node.children.items()),
+                            key=lambda item: item[1]))
+        i += 1
+
+    tokens = bytearray()
+    postings = bytearray()
+    records: List[Optional[tuple]] = [None] * len(nodes)
+    subtree_blocks: List[Tuple[int, int]] = [(0, 0)] * len(nodes)
+
+    def add_block(bitmap: BitMap) -> Tuple[int, int]:
+        if not bitmap:
+            return (0, 0)
+        data = bitmap.serialize()
+        offset = len(postings)
+        postings.extend(data)
+        return (offset, len(data))
+
+    # Children have larger indexes than their parent, so going backwards visits them first
+    for index in range(len(nodes) - 1, -1, -1):
+        node, (token_flag, token) = nodes[index]
+        child_count = len(node.children)
+
+        own_block = add_block(node.file_postings) if node.is_end_of_word else (0, 0)
+        if not node.is_end_of_word and child_count == 1:
+            subtree_block = subtree_blocks[first_child[index]]
+        elif child_count == 0:
+            subtree_block = own_block
+        else:
+            subtree_block = add_block(node.subtree_postings)
+        subtree_blocks[index] = subtree_block
+
+        flags = token_flag | (FLAG_END_OF_WORD if node.is_end_of_word else 0)
+        records[index] = (len(tokens), len(token), first_child[index], child_count,
+                          own_block[0], own_block[1], subtree_block[0], subtree_block[1], flags)
+        tokens.extend(token)
+
+    refs = [iwt.file_ids.decode(file_id).encode() for file_id in range(len(iwt.file_ids))]
+    ref_offsets = [0]
+    for ref in refs:
+        ref_offsets.append(ref_offsets[-1] + len(ref))
+
+    tokens_offset = HEADER.size + NODE.size * len(nodes)
+    postings_offset = tokens_offset + len(tokens)
+    refs_offset = postings_offset + len(postings)
+
+    tmp_path = f"{os.fspath(path)}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, FORMAT_VERSION, len(nodes), len(refs), iwt.version,
+                            tokens_offset, postings_offset, refs_offset))
+        for record in records:
+            f.write(NODE.pack(*record))
+        f.write(tokens)
+        f.write(postings)
+        f.write(struct.pack(f'<{len(ref_offsets)}Q', *ref_offsets))
+        for ref in refs:
+            f.write(ref)
+    os.replace(tmp_path, path)
+
+def load_iwt(path: str | os.PathLike) -> IndexWildcardTree:
+    """Fully deserialize a saved tree into a mutable IndexWildcardTree."""
+    with MappedIndexWildcardTree(path) as mapped:
+        iwt = IndexWildcardTree()
+        for file_id in range(mapped.file_count):
+            iwt.file_ids.encode(mapped.file_ids.decode(file_id))
+
+        stack = [(0, iwt.root)]
+        while stack:
+            index, node = stack.pop()
+            record = mapped._node(index)
+            if record[8] & FLAG_END_OF_WORD:
+                node.is_end_of_word = True
+                node.file_postings = mapped._postings(record[4], record[5])
+            node.subtree_postings = mapped._postings(record[6], record[7])
+            for child_index in range(record[2], record[2] + record[3]):
+                char = mapped._token(child_index)
+                child = TrieNode()
+                node.children[char] = child
+                stack.append((child_index, child))
+
+        # Word counts and the word-to-files mapping are derived, rebuild them
+        stack = [(iwt.root, '', [])]
+        while stack:
+            node, char, path = stack.pop()
+            path = path + [node]
+            if node.is_end_of_word:
+                iwt.word_to_files[char] |= node.file_postings
+                for path_node in path:
+                    path_node.word_count += 1
+            for child_char, child in node.children.items():
+                stack.append((child, child_char, path))
+
+        iwt.version = mapped.version
+
+    return iwt
+
+class MappedFileIds:
+    """Read-only file id dictionary backed by the mapped file refs section."""
+
+    def __init__(self, buffer: mmap.mmap, offset: int, count: int):
+        self._buffer = buffer
+        self._offsets = offset
+        self._data = offset + 8 * (count + 1)
+        self._count = count
+
+    def __len__(self) -> int:
+        return self._count
+
+    def decode(self, file_id: int) -> str:
+        start, end = struct.unpack_from('<2Q', self._buffer, self._offsets + 8 * file_id)
+        return self._buffer[self._data + start:self._data + end].decode()
+
+    def to_refs(self, postings: BitMap) -> Set[str]:
+        return {self.decode(file_id) for file_id in postings}
+
+class MappedIndexWildcardTree:
+    """
+    Read-only IWT answering queries straight from a memory-mapped file written by write_iwt.
+    Nothing is deserialized up front: a lookup touches only the node records, tokens and
+    posting blocks on its path, and processes mapping the same file share the page cache.
+    """
+
+    def __init__(self, path: str | os.PathLike):
+        self.path = os.fspath(path)
+        with open(self.path, 'rb') as f:
+            self._buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        (magic, format_version, self.node_count, self.file_count, self.version,
+         self._tokens, self._postings_base, refs_offset) = HEADER.unpack_from(self._buffer)
+        if magic != MAGIC:
+            self._buffer.close()
+            raise ValueError(f"{self.path} is not an IWT file")
+        if format_version != FORMAT_VERSION:
+            self._buffer.close()
+            raise ValueError(f"Unsupported IWT format version {format_version}")
+
+        self.file_ids = MappedFileIds(self._buffer, refs_offset, self.file_count)
+
+    def close(self):
+        self._buffer.close()
+
+    def snapshot(self) -> 'MappedIndexWildcardTree':
+        """The mapped file never changes, so the tree is its own snapshot."""
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _node(self, index: int) -> tuple:
+        return NODE.unpack_from(self._buffer, HEADER.size + NODE.size * index)
+
+    def _token_key(self, record: tuple) -> Tuple[int, bytes]:
+        start = self._tokens + record[0]
+        return (record[8] & FLAG_HEX_TOKEN, self._buffer[start:start + record[1]])
+
+    def _token(self, index: int) -> str:
+        return _decode_token(*self._token_key(self._node(index)))
+
+    def _postings(self, offset: int, length: int) -> BitMap:
+        if not length:
+            return BitMap()
+        start = self._postings_base + offset
+        return BitMap.deserialize(self._buffer[start:start + length])
+
+    def _child(self, record: tuple, char: str) -> Optional[int]:
+        """Index of the child reached by a token, by binary search over the sorted children."""
+        key = _encode_token(char)
+        low, high = record[2], record[2] + record[3]
+        while low < high:
+            middle = (low + high) // 2
+            middle_key = self._token_key(self._node(middle))
+            if middle_key == key:
+                return middle
+            if middle_key < key:
+                low = middle + 1
+            else:
+                high = middle
+        return None
+
+    def search_postings(self, word: List[str]) -> Optional[BitMap]:
+        """Search for a word and return the ids of the files that contain it."""
+        if not word:
+            return None
+
+        index = 0
+        record = self._node(index)
+        for char in word:
+            index = self._child(record, char)
+            if index is None:
+                return None
+            record = self._node(index)
+
+        if record[8] & FLAG_END_OF_WORD:
+            return self._postings(record[4], record[5])
+        return None
+
+    def search(self, word: List[str]) -> Optional[Set[str]]:
+        """Search for a word and return the files that contain it."""
+        postings = self.search_postings(word)
+        return self.file_ids.to_refs(postings) if postings is not None else None
+
+    def wildcard_files_only(self, pattern: List[str], limit: Optional[int] = None) -> Set[str]:
+        """Get only the files that contain words matching the wildcard pattern, at most limit of them."""
+        if limit is not None:
+            return {self.file_ids.decode(file_id)
+                    for file_id in itertools.islice(self.iter_wildcard_file_ids(pattern), limit)}
+        return self.file_ids.to_refs(self.wildcard_postings(pattern))
+
+    def iter_wildcard_file_ids(self, pattern: List[str], stats: Optional[RequestStats] = None) -> Iterator[int]:
+        """Ids of the files matching the wildcard pattern, each once, found lazily as the trie is traversed."""
+        if not pattern:
+            return iter(())
+
+        head = trailing_star_head(pattern)
+        if head < len(pattern):
+            return iter_distinct(self._postings(record[6], record[7])
+                                 for record in self._iter_match_nodes(0, pattern[:head], False, stats))
+        return iter_distinct(self._postings(record[4], record[5])
+                             for record in self._iter_match_nodes(0, pattern, True, stats))
+
+    def wildcard_postings(self, pattern: List[str], stats: Optional[RequestStats] = None) -> BitMap:
+        """Ids of the files that contain words matching the wildcard pattern."""
+        if not pattern:
+            return BitMap()
+        return self._postings_from(0, pattern, stats)
+
+    def wildcard_postings_many(self, patterns: List[List[str]],
+                               stats: Optional[RequestStats] = None) -> Dict[Tuple[str, ...], BitMap]:
+        """Evaluate several patterns, each distinct pattern once, keyed by tuple(pattern)."""
+        results: Dict[Tuple[str, ...], BitMap] = {}
+        for pattern in patterns:
+            key = tuple(pattern)
+            if key not in results:
+                results[key] = self.wildcard_postings(pattern, stats)
+        return results
+
+    def _postings_from(self, index: int, pattern: List[str], stats: Optional[RequestStats] = None) -> BitMap:
+        # Trailing '*': every node reached by the head contributes its stored subtree postings
+        head = trailing_star_head(pattern)
+        if head < len(pattern):
+            return union_all(self._postings(record[6], record[7])
+                             for record in self._match_nodes(index, pattern[:head], False, stats))
+        return union_all(self._postings(record[4], record[5])
+                         for record in self._match_nodes(index, pattern, True, stats))
+
+    def _match_nodes(self, start: int, pattern: List[str], words_only: bool,
+                     stats: Optional[RequestStats] = None) -> List[tuple]:
+        """Same NFA walk as IndexWildcardTree._match_nodes, over node indexes."""
+        return list(self._iter_match_nodes(start, pattern, words_only, stats))
+
+    def _iter_match_nodes(self, start: int, pattern: List[str], words_only: bool,
+                          stats: Optional[RequestStats] = None) -> Iterator[tuple]:
+        end = len(pattern)
+        stack = [(start, 0)]
+        visited = {(start, 0)}
+        branches = 0     # Children expanded by '*' and '?'
+
+        def push(index: int, pattern_idx: int):
+            if (index, pattern_idx) not in visited:
+                visited.add((index, pattern_idx))
+                stack.append((index, pattern_idx))
+
+        try:
+            while stack:
+                index, pattern_idx = stack.pop()
+                record = self._node(index)
+
+                if pattern_idx == end:
+                    if not words_only or record[8] & FLAG_END_OF_WORD:
+                        yield record
+                    continue
+
+                char = pattern[pattern_idx]
+                children = range(record[2], record[2] + record[3])
+
+                if char == '*':
+                    push(index, pattern_idx + 1)
+                    branches += len(children)
+                    for child in children:
+                        push(child, pattern_idx)
+
+                elif char == '?':
+                    branches += len(children)
+                    for child in children:
+                        push(child, pattern_idx + 1)
+
+                else:
+                    child = self._child(record, char)
+                    if child is not None:
+                        push(child, pattern_idx + 1)
+        finally:
+            if stats is not None:
+                stats.count('trie_nodes_visited', len(visited))
+                stats.count('wildcard_branches', branches)
@@ -1,4 +1,5 @@
 import hmac, hashlib, re
+from typing import List
 from charm.toolbox.pairinggroup import G1, G2
 
 def prf(key: bytes, message: str | bytes) -> int:
@@ -29,18 +30,47 @@ def gen_pseudo_policy(key: bytes, policy: str):
 
 # BY CHATGPT
 class HomomorphicMAC:
-    def __init__(self, group_obj, secret_key):
+    """
+    Tag m as g^(m*sk), verified against vk = h^sk. setup() gives g and h fixed-base exponentiation tables
+    once; contexts made by with_key share them, so one long-lived instance serves every per-file key.
+    HomomorphicMAC(group, sk) is the one-off context: fresh generators, no tables, vk computed at once.
+    """
+    def __init__(self, group_obj, secret_key=None, g=None, h=None):
         self.group = group_obj
-        self.g = self.group.random(G1)
-        self.h = self.group.random(G2)
+        self.g = g if g is not None else self.group.random(G1)
+        self.h = h if h is not None else self.group.random(G2)
         self.sk = secret_key
-        self.vk = self.h ** self.sk      # verification key
+        self.__vk = self.h ** self.sk if h is None and secret_key is not None else None
+        self.__e_g_vk = None
+
+    @classmethod
+    def setup(cls, group_obj, label: str = 'abse-homomorphic-mac') -> 'HomomorphicMAC':
+        """Context on generators hashed from label, so every party and process derives the same g and h."""
+        g = group_obj.hash(label + ':g', G1)
+        h = group_obj.hash(label + ':h', G2)
+        g.initPP()
+        h.initPP()
+        return cls(group_obj, None, g, h)
+
+    def with_key(self, secret_key) -> 'HomomorphicMAC':
+        """Context for another secret key on the same generators and precomputed tables."""
+        return HomomorphicMAC(self.group, secret_key, self.g, self.h)
+
+    @property
+    def vk(self):
+        # verification key, only computed when verifying
+        if self.__vk is None:
+            self.__vk = self.h ** self.sk
+        return self.__vk
 
     def sign(self, m):
         # m is an integer message (you can hash your data to int)
         tag = self.g ** (m * self.sk)
         return tag
 
+    def sign_many(self, messages: List) -> List:
+        return [self.g ** (m * self.sk) for m in messages]
+
     def aggregate_tags(self, tags):
         agg_tag = 1
         for i, tag in enumerate(tags):
@@ -50,8 +80,10 @@ class HomomorphicMAC:
         return agg_tag
 
     def verify(self, m_sum, tag):
-        # Checks e(tag, h) == e(g, vk)^m_sum
+        # Checks e(tag, h) == e(g, vk)^m_sum, e(g, vk) is paired once per key
+        if self.__e_g_vk is None:
+            self.__e_g_vk = self.group.pair_prod(self.g, self.vk)
+            self.__e_g_vk.initPP()
         left = self.group.pair_prod(tag, self.h)
-        right = self.group.pair_prod(self.g, self.vk) ** m_sum
+        right = self.__e_g_vk ** m_sum
         return left == right
-    
\ No newline at end of file
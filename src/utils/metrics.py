@@ -0,0 +1,127 @@
+import contextlib, json, threading, time
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional
+
+_NO_TIMER = contextlib.nullcontext()
+
+class RequestStats:
+    """Counters and timers (seconds) collected while serving one request."""
+    __slots__ = ('operation', 'counters', 'timers')
+
+    def __init__(self, operation: str):
+        self.operation = operation
+        self.counters: Dict[str, int] = {}
+        self.timers: Dict[str, float] = {}
+
+    def count(self, name: str, n: int = 1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def add_time(self, name: str, seconds: float):
+        self.timers[name] = self.timers.get(name, 0.0) + seconds
+
+    @contextlib.contextmanager
+    def timer(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"operation": self.operation, "counters": dict(self.counters), "timers": dict(self.timers)}
+
+def timer(stats: Optional[RequestStats], name: str):
+    """stats.timer(name), or a no-op context when instrumentation is off (stats is None)."""
+    return stats.timer(name) if stats is not None else _NO_TIMER
+
+class Metrics:
+    """
+    Aggregates the RequestStats of every request: counter totals and, per timer, the number
+    of observations, their sum and maximum. The last `recent` requests are kept as they were.
+    """
+    enabled = True
+
+    def __init__(self, namespace: str = 'abse', recent: int = 100):
+        self.namespace = namespace
+        self.__lock = threading.Lock()
+        self.__requests: Dict[str, int] = {}
+        self.__counters: Dict[str, int] = {}
+        self.__timers: Dict[str, List[float]] = {}     # name -> [count, sum, max]
+        self.__recent: Deque[RequestStats] = deque(maxlen=recent)
+
+    def request(self, operation: str) -> Optional[RequestStats]:
+        return RequestStats(operation)
+
+    def record(self, stats: Optional[RequestStats]):
+        if stats is None:
+            return
+        with self.__lock:
+            self.__requests[stats.operation] = self.__requests.get(stats.operation, 0) + 1
+            for name, n in stats.counters.items():
+                self.__counters[name] = self.__counters.get(name, 0) + n
+            for name, seconds in stats.timers.items():
+                timer = self.__timers.setdefault(name, [0, 0.0, 0.0])
+                timer[0] += 1
+                timer[1] += seconds
+                timer[2] = max(timer[2], seconds)
+            self.__recent.append(stats)
+
+    def reset(self):
+        with self.__lock:
+            self.__requests.clear()
+            self.__counters.clear()
+            self.__timers.clear()
+            self.__recent.clear()
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self.__lock:
+            return {
+                "requests": dict(self.__requests),
+                "counters": dict(self.__counters),
+                "timers": {name: {"count": count, "sum": total, "max": longest}
+                           for name, (count, total, longest) in self.__timers.items()},
+                "recent": [stats.to_dict() for stats in self.__recent]
+            }
+
+    def to_json(self) -> str:
+        return json.dumps(self.snapshot())
+
+    def to_prometheus(self) -> str:
+        """Prometheus text exposition format: counters as *_total, timers as *_seconds summaries."""
+        snapshot = self.snapshot()
+        prefix = self.namespace
+        lines = [f"# TYPE {prefix}_requests_total counter"]
+        for operation, n in sorted(snapshot["requests"].items()):
+            lines.append(f'{prefix}_requests_total{{operation="{operation}"}} {n}')
+        for name, n in sorted(snapshot["counters"].items()):
+            lines.append(f"# TYPE {prefix}_{name}_total counter")
+            lines.append(f"{prefix}_{name}_total {n}")
+        for name, timer in sorted(snapshot["timers"].items()):
+            lines.append(f"# TYPE {prefix}_{name}_seconds summary")
+            lines.append(f"{prefix}_{name}_seconds_count {timer['count']}")
+            lines.append(f"{prefix}_{name}_seconds_sum {timer['sum']:.9f}")
+            lines.append(f"# TYPE {prefix}_{name}_seconds_max gauge")
+            lines.append(f"{prefix}_{name}_seconds_max {timer['max']:.9f}")
+        return "\n".join(lines) + "\n"
+
+class NullMetrics:
+    """Metrics when instrumentation is disabled: requests get no stats object, so nothing is collected."""
+    enabled = False
+
+    def request(self, operation: str) -> Optional[RequestStats]:
+        return None
+
+    def record(self, stats: Optional[RequestStats]):
+        pass
+
+    def reset(self):
+        pass
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {"requests": {}, "counters": {}, "timers": {}, "recent": []}
+
+    def to_json(self) -> str:
+        return json.dumps(self.snapshot())
+
+    def to_prometheus(self) -> str:
+        return ""
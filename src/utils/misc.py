@@ -1,5 +1,5 @@
-import pathlib, time, re, ast, operator
-from typing import Callable, Any, List
+import pathlib, time, re, functools
+from typing import Callable, Any, List, Iterable, AbstractSet
 
 base_path = pathlib.Path(__file__).parent.parent.parent / "files"
 
@@ -17,34 +17,108 @@ def measure_computation_time(fn: Callable[..., Any], *args, iterations: int = 10
     avg_time_ms = total_time / iterations * 1000
     print(f"    Average time over {iterations} iterations: {avg_time_ms} ms")
 
-OPS = {
-    ast.And: all,
-    ast.Or: any,
-    ast.Not: operator.not_
-}
-
-def __eval_expr(node, symbols):
-    if isinstance(node, ast.BoolOp):
-        op_func = OPS[type(node.op)]
-        return op_func([__eval_expr(v, symbols) for v in node.values])
-    elif isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not):
-        return operator.not_(__eval_expr(node.operand, symbols))
-    elif isinstance(node, ast.Constant):
-        return node.value in symbols
-    elif isinstance(node, ast.Expr):
-        return __eval_expr(node.value, symbols)
-    else:
-        raise ValueError("Unsupported expression node:", node)
-
-def __quote_attributes(policy_str):
-    pattern = re.compile(r'\b(?!and\b|or\b|not\b)[a-zA-Z0-9_]+\b')
-    return pattern.sub(lambda m: f'"{m.group(0)}"', policy_str)
-
-def eval_policy(access_policy: str, attrs: List[str]) -> bool:
-    try:
-        access_policy = __quote_attributes(access_policy)
-        expr_ast = ast.parse(access_policy, mode='eval')
-        return __eval_expr(expr_ast.body, attrs)
-    except Exception as e:
-        print("Error:", e)
-        return False
\ No newline at end of file
+_POLICY_TOKEN = re.compile(r'\s*(?:(\()|(\))|([a-zA-Z0-9_]+))')
+_OPERATORS = {'and', 'or', 'not'}
+# Deepest nesting of parentheses and 'not' accepted, well within Python's recursion limit
+_MAX_POLICY_DEPTH = 100
+
+def __tokenize_policy(access_policy: str) -> List[str]:
+    tokens = []
+    pos = 0
+    access_policy = access_policy.rstrip()
+    while pos < len(access_policy):
+        match = _POLICY_TOKEN.match(access_policy, pos)
+        if not match:
+            raise ValueError(f"Unexpected character in policy at {pos}: {access_policy[pos:pos+10]!r}")
+        tokens.append(match.group(match.lastindex))
+        pos = match.end()
+    return tokens
+
+class _PolicyParser:
+    """
+    Recursive descent over the policy grammar, with Python's precedence (not > and > or):
+        expr := term ('or' term)*    term := factor ('and' factor)*
+        factor := 'not' factor | '(' expr ')' | attribute
+    Each rule returns a closure over the user's attribute set.
+    """
+
+    def __init__(self, tokens: List[str]):
+        self.tokens = tokens
+        self.pos = 0
+        self.depth = 0
+
+    def peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else None
+
+    def take(self):
+        token = self.peek()
+        if token is None:
+            raise ValueError("Unexpected end of policy")
+        self.pos += 1
+        return token
+
+    def parse(self) -> Callable[[AbstractSet[str]], bool]:
+        evaluator = self.expr()
+        if self.peek() is not None:
+            raise ValueError(f"Unexpected token in policy: {self.peek()!r}")
+        return evaluator
+
+    def expr(self):
+        terms = [self.term()]
+        while self.peek() == 'or':
+            self.take()
+            terms.append(self.term())
+        if len(terms) == 1:
+            return terms[0]
+        return lambda attrs: any(term(attrs) for term in terms)
+
+    def term(self):
+        factors = [self.factor()]
+        while self.peek() == 'and':
+            self.take()
+            factors.append(self.factor())
+        if len(factors) == 1:
+            return factors[0]
+        return lambda attrs: all(factor(attrs) for factor in factors)
+
+    def factor(self):
+        token = self.take()
+        if token in ('not', '('):
+            self.depth += 1
+            if self.depth > _MAX_POLICY_DEPTH:
+                raise ValueError(f"Policy nested deeper than {_MAX_POLICY_DEPTH} levels")
+            if token == 'not':
+                operand = self.factor()
+                inner = lambda attrs: not operand(attrs)
+            else:
+                inner = self.expr()
+                if self.take() != ')':
+                    raise ValueError("Unbalanced parentheses in policy")
+            self.depth -= 1
+            return inner
+        if token == ')' or token in _OPERATORS:
+            raise ValueError(f"Unexpected token in policy: {token!r}")
+        return lambda attrs: token in attrs
+
+@functools.lru_cache(maxsize=4096)
+def compile_policy(access_policy: str) -> Callable[[AbstractSet[str]], bool]:
+    """
+    Compile an access policy once into an evaluator taking a set of attributes.
+    Compiled policies are cached by policy string. Raises ValueError for a malformed policy.
+    """
+    return _PolicyParser(__tokenize_policy(access_policy)).parse()
+
+def eval_policies(access_policies: Iterable[str], attrs: Iterable[str]) -> List[bool]:
+    """Evaluate one attribute set against many policies. Malformed policies deny access."""
+    attrs = attrs if isinstance(attrs, (set, frozenset)) else frozenset(attrs)
+    results = []
+    for access_policy in access_policies:
+        try:
+            results.append(compile_policy(access_policy)(attrs))
+        except ValueError:
+            results.append(False)
+    return results
+
+def eval_policy(access_policy: str, attrs: Iterable[str]) -> bool:
+    """Evaluate a policy against the given attributes. Malformed policies deny access."""
+    return eval_policies([access_policy], attrs)[0]
@@ -0,0 +1,196 @@
+"""
+Asyncio TCP transport between CloudServer and its clients: the framing and the client.
+The server side is entities.cloud_server_frontend.CloudServerFrontend.
+
+Every frame is a 4-byte big-endian body length followed by a msgpack body. A request is
+[request_id, op, args] and its response [request_id, ok, result or error message].
+Responses are sent as soon as each request finishes, so a client can pipeline many
+requests on one connection and match the answers by request id. A streaming request is
+answered by any number of [request_id, None, item] frames before its final response.
+Encrypted files are always streamed, as [file reference, piece, last] items of at most
+1 MiB each, so their size is not limited by MAX_FRAME_SIZE. A client that stops reading a
+stream early sends [request_id, "cancel", [stream_request_id]], which gets no response.
+The Data Owner's operations (uploads and IWT updates) take the owner token as their first
+argument; a frontend without an owner token does not serve them.
+"""
+import asyncio, contextlib, itertools, os, struct, tempfile
+from typing import Any, AsyncIterator, Dict, List, Optional, Set, Tuple
+import msgpack
+from utils.iwt import IndexWildcardTree, IWTDelta
+from utils.iwt_file import write_iwt
+from utils.serialize import serialize_enc_cert, serialize_iwt_delta
+
+FRAME_HEADER = struct.Struct('>I')
+MAX_FRAME_SIZE = 256 * 2**20
+
+def pack_frame(message: Any) -> bytes:
+    body = msgpack.packb(message)
+    if len(body) > MAX_FRAME_SIZE:
+        raise ValueError(f"Frame of {len(body)} bytes exceeds the {MAX_FRAME_SIZE} byte limit")
+    return FRAME_HEADER.pack(len(body)) + body
+
+async def read_frame(reader: asyncio.StreamReader) -> Any:
+    """Next message on the stream. Raises asyncio.IncompleteReadError once the peer has closed."""
+    (length,) = FRAME_HEADER.unpack(await reader.readexactly(FRAME_HEADER.size))
+    if length > MAX_FRAME_SIZE:
+        raise ValueError(f"Frame of {length} bytes exceeds the {MAX_FRAME_SIZE} byte limit")
+    return msgpack.unpackb(await reader.readexactly(length))
+
+class CloudServerClient:
+    """
+    Asyncio client of CloudServerFrontend. Calls may be issued concurrently: they are
+    pipelined on the one connection and resolved as their responses arrive.
+    At most max_buffered frames of a request wait to be read; while they do, the connection
+    is not read at all, so a slow stream reader holds up the server through TCP flow control
+    (and delays the other responses on the connection).
+    The upload and IWT update calls need the owner token the frontend was started with.
+    """
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, owner_token: Optional[bytes] = None,
+                 max_buffered: int = 16):
+        self.__owner_token = owner_token
+        self.__reader = reader
+        self.__writer = writer
+        self.__ids = itertools.count()
+        self.__max_buffered = max_buffered
+        self.__pending: Dict[int, asyncio.Queue] = {}     # Response frames of unfinished requests by request id
+        self.__write_lock = asyncio.Lock()
+        self.__receiver = asyncio.create_task(self.__receive())
+
+    @classmethod
+    async def connect(cls, host: str = '127.0.0.1', port: int = 0, owner_token: Optional[bytes] = None,
+                      max_buffered: int = 16) -> 'CloudServerClient':
+        reader, writer = await asyncio.open_connection(host, port)
+        return cls(reader, writer, owner_token, max_buffered)
+
+    async def close(self):
+        self.__writer.close()
+        with contextlib.suppress(ConnectionError):
+            await self.__writer.wait_closed()
+        await self.__receiver
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def request(self, op: str, *args) -> Any:
+        async with contextlib.aclosing(self.__exchange(op, args)) as frames:
+            async for ok, result in frames:
+                if ok:
+                    return result
+
+    async def stream(self, op: str, *args) -> AsyncIterator[Any]:
+        """Items of a streaming request as they arrive."""
+        async with contextlib.aclosing(self.__exchange(op, args)) as frames:
+            async for ok, result in frames:
+                if ok is None:
+                    yield result
+
+    async def __exchange(self, op: str, args: tuple) -> AsyncIterator[Tuple[Optional[bool], Any]]:
+        # Response frames of one request up to and including the final one; an error frame is raised
+        if self.__receiver.done():
+            raise ConnectionError("Connection to the cloud server is closed")
+
+        request_id = next(self.__ids)
+        frames = asyncio.Queue(maxsize=self.__max_buffered)
+        self.__pending[request_id] = frames
+        finished = False
+        try:
+            async with self.__write_lock:
+                self.__writer.write(pack_frame([request_id, op, list(args)]))
+                await self.__writer.drain()
+
+            while True:
+                ok, result = await frames.get()
+                if ok is not None:
+                    finished = True
+                if ok is False:
+                    raise result
+                yield ok, result
+                if ok:
+                    return
+        finally:
+            self.__pending.pop(request_id, None)
+            # Unblock the receiver if it waits for room in this queue
+            while not frames.empty():
+                frames.get_nowait()
+            if not finished and not self.__writer.is_closing():
+                # Abandoned: stop the server's work. One write call, so it cannot split another frame
+                self.__writer.write(pack_frame([next(self.__ids), "cancel", [request_id]]))
+
+    async def __receive(self):
+        try:
+            while True:
+                request_id, ok, result = await read_frame(self.__reader)
+                frames = self.__pending.get(request_id) if ok is None else self.__pending.pop(request_id, None)
+                if frames is None:
+                    continue    # Abandoned stream
+                if ok is False:
+                    result = Exception(f"Cloud server: {result}")
+                # Waits while the reader is max_buffered frames behind, and stops reading the connection meanwhile
+                await frames.put((ok, result))
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            # Requests still waiting for their final frame fail; their unread items are dropped for the error
+            for frames in self.__pending.values():
+                while frames.full():
+                    frames.get_nowait()
+                frames.put_nowait((False, ConnectionError("Connection to the cloud server closed")))
+
+    async def proceed_queries(self, queries: List[List[str]], enc_attribute_cert: dict[str, bytes]) -> Set[str]:
+        return set(await self.request("proceed_queries", queries, serialize_enc_cert(enc_attribute_cert)))
+
+    async def proceed_queries_page(self, queries: List[List[str]], enc_attribute_cert: dict[str, bytes], limit: int,
+                                   cursor: Optional[str] = None) -> Tuple[Set[str], Optional[str]]:
+        """One page of results and the cursor for the next one (None on the last page)."""
+        files, cursor = await self.request("proceed_queries_page", queries, serialize_enc_cert(enc_attribute_cert),
+                                           limit, cursor)
+        return set(files), cursor
+
+    async def stream_queries(self, queries: List[List[str]], enc_attribute_cert: dict[str, bytes],
+                             with_ciphertext: bool = False) -> AsyncIterator[str | Tuple[str, bytes, bool]]:
+        """
+        Authorized file references as the server finds them, or with with_ciphertext the encrypted files
+        themselves as (reference, piece, last) triples, see CloudServer.stream_queries.
+        """
+        async for item in self.stream("stream_queries", queries, serialize_enc_cert(enc_attribute_cert), with_ciphertext):
+            yield tuple(item) if with_ciphertext else item
+
+    async def fetch_ehrs(self, filerefs: List[str], enc_attribute_cert: dict[str, bytes]) -> Dict[str, bytes]:
+        """Authorized encrypted files, each reassembled in memory; see fetch_ehr_chunks for large files."""
+        pieces: Dict[str, List[bytes]] = {}
+        async for fileref, chunk, _ in self.fetch_ehr_chunks(filerefs, enc_attribute_cert):
+            pieces.setdefault(fileref, []).append(chunk)
+        return {fileref: b''.join(chunks) for fileref, chunks in pieces.items()}
+
+    async def fetch_ehr_chunks(self, filerefs: List[str],
+                               enc_attribute_cert: dict[str, bytes]) -> AsyncIterator[Tuple[str, bytes, bool]]:
+        """Authorized encrypted files as (reference, piece, last) triples, see CloudServer.fetch_ehr_chunks."""
+        async for item in self.stream("fetch_ehrs", list(filerefs), serialize_enc_cert(enc_attribute_cert)):
+            yield tuple(item)
+
+    async def upload_ehr(self, fileref: str, ctkmac_bytes: bytes):
+        await self.request("upload_ehr", self.__owner_token, fileref, ctkmac_bytes)
+
+    async def upload_iwt(self, iwt: IndexWildcardTree) -> int:
+        """Send a whole IWT; returns its version on the server."""
+        fd, path = tempfile.mkstemp(suffix='.iwt')
+        os.close(fd)
+        try:
+            write_iwt(iwt, path)
+            with open(path, 'rb') as f:
+                iwt_bytes = f.read()
+        finally:
+            os.remove(path)
+        return await self.request("upload_iwt", self.__owner_token, iwt_bytes)
+
+    async def apply_iwt_delta(self, delta: IWTDelta) -> int:
+        """Send an IWT update; returns the server's IWT version afterwards."""
+        return await self.request("apply_iwt_delta", self.__owner_token, serialize_iwt_delta(delta))
+
+    async def metrics(self, format: str = 'prometheus') -> str:
+        """The server's search metrics, as Prometheus text ('prometheus') or a JSON document ('json')."""
+        return await self.request("metrics", format)
@@ -0,0 +1,69 @@
+from typing import Dict, List, Set, Iterable, Iterator, Optional
+from pyroaring import BitMap
+
+class FileIdDictionary:
+    """
+    Dictionary encoding of file references.
+    Every reference (e.g. "1_encrypted") gets a dense integer id, so postings can be kept
+    as compressed bitmaps and unions/intersections become bitwise operations.
+    Ids are never reused; strings are only materialized at the API boundary.
+    """
+
+    def __init__(self):
+        self._ids: Dict[str, int] = {}
+        self._refs: List[str] = []
+
+    def __len__(self) -> int:
+        return len(self._refs)
+
+    def encode(self, ref: str) -> int:
+        """Id of a reference, assigning a new one if needed."""
+        file_id = self._ids.get(ref)
+        if file_id is None:
+            file_id = len(self._refs)
+            self._ids[ref] = file_id
+            self._refs.append(ref)
+        return file_id
+
+    def lookup(self, ref: str) -> Optional[int]:
+        """Id of a known reference, None otherwise."""
+        return self._ids.get(ref)
+
+    def decode(self, file_id: int) -> str:
+        return self._refs[file_id]
+
+    def to_postings(self, refs: Iterable[str]) -> BitMap:
+        """Bitmap of the known references among refs."""
+        ids = self._ids
+        return BitMap(ids[ref] for ref in refs if ref in ids)
+
+    def to_refs(self, postings: BitMap) -> Set[str]:
+        """Materialize a bitmap as a set of file references."""
+        refs = self._refs
+        return {refs[file_id] for file_id in postings}
+
+def union_all(postings: Iterable[BitMap]) -> BitMap:
+    """Union of any number of bitmaps (empty bitmap if there are none)."""
+    return BitMap.union(BitMap(), *postings)
+
+def intersect_all(postings: List[BitMap]) -> BitMap:
+    """Intersection of bitmaps, smallest first, stopping as soon as it is empty."""
+    if not postings:
+        return BitMap()
+
+    postings = sorted(postings, key=len)
+    result = postings[0]
+    for other in postings[1:]:
+        if not result:
+            break
+        result = result & other
+    return result
+
+def iter_distinct(postings: Iterable[BitMap]) -> Iterator[int]:
+    """Ids of a stream of bitmaps, each id once, without building their union up front."""
+    seen = BitMap()
+    for bitmap in postings:
+        for file_id in bitmap:
+            if file_id not in seen:
+                seen.add(file_id)
+                yield file_id
@@ -0,0 +1,133 @@
+import os, shutil, tempfile, threading
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Dict, List, Optional, Set, Tuple
+from utils.iwt import IndexWildcardTree
+from utils.iwt_file import MappedIndexWildcardTree, write_iwt
+from utils.postings import intersect_all
+
+# A published snapshot: its path, the inode and modification time of the file there, and its IWT version.
+# A file replaced at the same path (write_iwt uses os.replace) gets another key, so workers map it anew
+SnapshotKey = Tuple[str, int, int, int]
+
+# Snapshots mapped by the current worker process, most recently used last
+_worker_snapshots: 'OrderedDict[SnapshotKey, MappedIndexWildcardTree]' = OrderedDict()
+_WORKER_SNAPSHOT_LIMIT = 2
+
+def _snapshot_key(path: str, version: int) -> SnapshotKey:
+    stat = os.stat(path)
+    return (path, stat.st_ino, stat.st_mtime_ns, version)
+
+def _worker_snapshot(key: SnapshotKey) -> MappedIndexWildcardTree:
+    snapshot = _worker_snapshots.get(key)
+    if snapshot is None:
+        snapshot = MappedIndexWildcardTree(key[0])
+        if snapshot.version != key[3]:
+            snapshot.close()
+            raise Exception(f"IWT snapshot {key[0]} was replaced after it was published")
+        _worker_snapshots[key] = snapshot
+        while len(_worker_snapshots) > _WORKER_SNAPSHOT_LIMIT:
+            _, oldest = _worker_snapshots.popitem(last=False)
+            oldest.close()
+    else:
+        _worker_snapshots.move_to_end(key)
+    return snapshot
+
+def _worker_search(key: SnapshotKey, queries: List[List[str]]) -> Set[str]:
+    snapshot = _worker_snapshot(key)
+    postings = intersect_all([snapshot.wildcard_postings(query) for query in queries])
+    return snapshot.file_ids.to_refs(postings)
+
+class SearchWorkerPool:
+    """
+    Pool of worker processes answering IWT searches from a read-only snapshot file.
+    Every worker memory-maps the snapshot, so they all share one copy through the page cache.
+    publish() writes a new snapshot and switches to it; queries already submitted keep the
+    snapshot they started on, which is deleted once nothing uses it anymore.
+    """
+
+    def __init__(self, workers: Optional[int] = None, snapshot_dir: Optional[str] = None):
+        self.__owns_dir = snapshot_dir is None
+        self.snapshot_dir = snapshot_dir if snapshot_dir is not None else tempfile.mkdtemp(prefix='iwt-snapshots-')
+        self.__executor = ProcessPoolExecutor(max_workers=workers)
+        self.__lock = threading.Lock()
+        self.__current: Optional[SnapshotKey] = None
+        self.version: Optional[int] = None      # IWT version of the current snapshot
+        self.__source: Optional[tuple] = None   # (file id dictionary, version) of the tree it was written from
+        self.__in_flight: Dict[SnapshotKey, int] = {}
+        self.__owned: Set[str] = set()      # Snapshot files written by the pool, deleted when retired
+        self.__published = 0
+
+    def publish(self, iwt: IndexWildcardTree | MappedIndexWildcardTree):
+        """Make a tree the snapshot served to new queries. A mapped tree is served from its own file."""
+        iwt = iwt.snapshot()
+        if isinstance(iwt, MappedIndexWildcardTree):
+            path, owned = iwt.path, False
+        else:
+            with self.__lock:
+                self.__published += 1
+                number = self.__published
+            path = os.path.join(self.snapshot_dir, f"iwt-{iwt.version}-{number}.bin")
+            write_iwt(iwt, path)
+            owned = True
+
+        key = _snapshot_key(path, iwt.version)
+        with self.__lock:
+            previous = self.__current
+            self.__current = key
+            self.version = iwt.version
+            self.__source = (iwt.file_ids, iwt.version)
+            if owned:
+                self.__owned.add(path)
+            self.__retire(previous)
+
+    def submit(self, queries: List[List[str]], iwt=None) -> Optional[Future]:
+        """
+        Queue a search; the future resolves to the set of matching file references.
+        With iwt, returns None instead unless the current snapshot was published from that tree at its version.
+        """
+        with self.__lock:
+            if self.__current is None:
+                raise Exception("No IWT snapshot published")
+            if iwt is not None and self.__source != (iwt.file_ids, iwt.version):
+                return None
+            key = self.__current
+            self.__in_flight[key] = self.__in_flight.get(key, 0) + 1
+
+        future = self.__executor.submit(_worker_search, key, queries)
+        future.add_done_callback(lambda _: self.__release(key))
+        return future
+
+    def search(self, queries: List[List[str]], iwt=None) -> Optional[Set[str]]:
+        future = self.submit(queries, iwt)
+        return future.result() if future is not None else None
+
+    def close(self):
+        self.__executor.shutdown(wait=True)
+        with self.__lock:
+            for path in list(self.__owned):
+                self.__delete(path)
+            self.__current = None
+            self.version = None
+            self.__source = None
+        if self.__owns_dir:
+            shutil.rmtree(self.snapshot_dir, ignore_errors=True)
+
+    def __release(self, key: SnapshotKey):
+        with self.__lock:
+            self.__in_flight[key] -= 1
+            if not self.__in_flight[key]:
+                del self.__in_flight[key]
+            self.__retire(key)
+
+    def __retire(self, key: Optional[SnapshotKey]):
+        # Called with the lock held: delete a snapshot once it is neither current nor in use
+        if key is not None and key != self.__current and key not in self.__in_flight and key[0] in self.__owned:
+            self.__delete(key[0])
+
+    def __delete(self, path: str):
+        self.__owned.discard(path)
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
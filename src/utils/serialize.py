@@ -1,5 +1,8 @@
-import msgpack
-from typing import Tuple, List
+import msgpack, io
+from typing import BinaryIO, Tuple, List, Any
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.hazmat.primitives import serialization
+from utils.iwt import IWTDelta
 
 def serialize_ctk(encrypted_key_bytes, ciphertext, iv):
     ctk = {
@@ -26,8 +29,16 @@ def serialize_ctkmac(ctk_bytes: bytes, mac_bytes: bytes, pseudo_policy: str) ->
     return ctkmac_bytes
 
 def deserialize_ctkmac(ctkmac_bytes: bytes) -> Tuple[bytes, bytes, str]:
-    ctkmac = msgpack.unpackb(ctkmac_bytes)
-    return (ctkmac["ctk"], ctkmac["mac"], ctkmac["pseudo_policy"])
+    return read_ctkmac(io.BytesIO(ctkmac_bytes))[:3]
+
+def read_ctkmac(enc_file: BinaryIO) -> Tuple[bytes, bytes, str, int]:
+    """
+    ctkmac at the start of an encrypted file and the offset where it ends. In a streamed file
+    (ctk ciphertext None) the chunked AES-GCM ciphertext follows from that offset, and is not read.
+    """
+    unpacker = msgpack.Unpacker(enc_file, read_size=1 << 16, max_buffer_size=0)
+    ctkmac = unpacker.unpack()
+    return (ctkmac["ctk"], ctkmac["mac"], ctkmac["pseudo_policy"], unpacker.tell())
 
 def serialize_cert(pseudo_attributes: List[str], signature: bytes) -> bytes:
     return msgpack.packb({
@@ -38,6 +49,38 @@ def serialize_cert(pseudo_attributes: List[str], signature: bytes) -> bytes:
 def deserialize_cert(cert_bytes: bytes) -> dict[str, List[str] | bytes]:
     return msgpack.unpackb(cert_bytes)
 
+def serialize_iwt_delta(delta: IWTDelta) -> bytes:
+    return msgpack.packb({
+        "base_version": delta.base_version,
+        "version": delta.version,
+        "insertions": delta.insertions,
+        "removals": delta.removals,
+        "removed_files": delta.removed_files
+    })
+
+def deserialize_iwt_delta(delta_bytes: bytes) -> IWTDelta:
+    delta = msgpack.unpackb(delta_bytes)
+    return IWTDelta(delta["base_version"], delta["version"],
+                    [(word, filename) for word, filename in delta["insertions"]],
+                    [(word, filename) for word, filename in delta["removals"]],
+                    delta["removed_files"])
+
+def serialize_enc_cert(enc_attribute_cert: dict[str, bytes | Any]) -> dict[str, bytes]:
+    """Encrypted attribute certificate with its ephemeral public key as X9.62 point bytes, for msgpack."""
+    return {
+        "eph_pub": enc_attribute_cert["eph_pub"].public_bytes(serialization.Encoding.X962,
+                                                              serialization.PublicFormat.UncompressedPoint),
+        "ciphertext": enc_attribute_cert["ciphertext"],
+        "iv": enc_attribute_cert["iv"]
+    }
+
+def deserialize_enc_cert(package: dict[str, bytes]) -> dict[str, bytes | Any]:
+    return {
+        "eph_pub": ec.EllipticCurvePublicKey.from_encoded_point(ec.SECP256R1(), package["eph_pub"]),
+        "ciphertext": package["ciphertext"],
+        "iv": package["iv"]
+    }
+
 # def serialize_enccert(package: dict[str, bytes]) -> bytes:
 #     return msgpack.packb(package)
 
@@ -0,0 +1,89 @@
+import hmac, hashlib
+from typing import Dict, Iterable, List, Tuple
+from utils.cache import LRUCache
+
+WILDCARDS = (42, 63)    # *, ?
+
+class TrapdoorEngine:
+    """
+    Keyword trapdoors: token i is HMAC-SHA256(key, keyword[:i+1]) as hex. With wildcards, a '*' or '?'
+    byte is emitted as itself (it still extends the prefix of the following tokens).
+    The key is absorbed once; every keyword copies that state and extends it byte by byte, taking each
+    prefix digest from a copy, so a keyword costs O(L) hashing instead of O(L^2). Results are cached.
+    """
+
+    def __init__(self, key: bytes, cache_size: int = 4096):
+        self.__keyed = hmac.new(key, digestmod=hashlib.sha256)
+        self.__cache = LRUCache(cache_size)     # (keyword, wildcards) -> tokens
+
+    def generate(self, keyword: str | bytes, wildcards: bool = False) -> List[str]:
+        keyword = keyword.encode() if isinstance(keyword, str) else keyword
+        tokens = self.__cache.get((keyword, wildcards))
+        if tokens is None:
+            tokens = tuple(self.__tokens(self.__keyed.copy(), keyword, wildcards))
+            self.__cache.put((keyword, wildcards), tokens)
+        return list(tokens)
+
+    def generate_many(self, keywords: Iterable[str | bytes], wildcards: bool = False) -> List[List[str]]:
+        """
+        Trapdoors of a batch of keywords, in order. Each distinct keyword is computed once, and the
+        HMAC state of a prefix shared by several keywords is computed once.
+        """
+        keywords = [keyword.encode() if isinstance(keyword, str) else keyword for keyword in keywords]
+        found: Dict[bytes, Tuple[str, ...]] = {}
+        missing = []
+        for keyword in set(keywords):
+            cached = self.__cache.get((keyword, wildcards))
+            if cached is None:
+                missing.append(keyword)
+            else:
+                found[keyword] = cached
+
+        # Keywords are walked in sorted order; the state at the depth a keyword shares with the next
+        # one is saved, so the next keyword resumes from it instead of from the key
+        missing.sort()
+        saved = [(0, self.__keyed)]     # (depth, HMAC state) along the current keyword, deepest last
+        tokens: List[str] = []
+        for n, keyword in enumerate(missing):
+            shared = _common_prefix(missing[n - 1], keyword) if n else 0
+            while saved[-1][0] > shared:
+                saved.pop()
+            depth, state = saved[-1]
+            del tokens[depth:]
+            save_at = _common_prefix(keyword, missing[n + 1]) if n + 1 < len(missing) else 0
+
+            state = state.copy()
+            for i in range(depth, len(keyword)):
+                state.update(keyword[i:i+1])
+                tokens.append(chr(keyword[i]) if wildcards and keyword[i] in WILDCARDS
+                              else state.copy().hexdigest())
+                if i + 1 == save_at:
+                    saved.append((save_at, state.copy()))
+            found[keyword] = tuple(tokens)
+            self.__cache.put((keyword, wildcards), found[keyword])
+
+        return [list(found[keyword]) for keyword in keywords]
+
+    def cache_stats(self) -> Dict[str, int | float]:
+        return self.__cache.stats()
+
+    def clear_cache(self):
+        self.__cache.clear()
+
+    @staticmethod
+    def __tokens(state, keyword: bytes, wildcards: bool) -> List[str]:
+        tokens = []
+        for i in range(len(keyword)):
+            state.update(keyword[i:i+1])
+            if wildcards and keyword[i] in WILDCARDS:
+                tokens.append(chr(keyword[i]))
+            else:
+                tokens.append(state.copy().hexdigest())
+        return tokens
+
+def _common_prefix(a: bytes, b: bytes) -> int:
+    n = min(len(a), len(b))
+    i = 0
+    while i < n and a[i] == b[i]:
+        i += 1
+    return i